@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# License: BSD
+
+# Dump/export benchmarks:
+#   PYTHONPATH=. python bench/bench_dump.py --depths 1000,100000 --widths 1,32,512 -o bench.json
+#   PYTHONPATH=. python bench/bench_dump.py -o after.json --compare before.json
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from darkscope.software.dump import *
+
+
+def make_capture(depth, width, seed=0):
+    rng = np.random.default_rng(seed)
+    nwords = max(1, (width + 63)//64)
+    words = rng.integers(0, 2**64, size=(depth, nwords), dtype=np.uint64, endpoint=False)
+    if width % 64:
+        words[:, -1] &= np.uint64((1 << (width % 64)) - 1)
+    return DumpData(width, words)
+
+
+def make_layout(width, field_width=8):
+    return [("f{}".format(i), min(field_width, width - offset))
+        for i, offset in enumerate(range(0, width, field_width))]
+
+
+def measure(fn):
+    tracemalloc.start()
+    start = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak
+
+
+def benchmarks(data, layout, directory):
+    def decoded(flatten=False):
+        dump = Dump()
+        if flatten:
+            dump.add_from_layout_flatten(layout, data)
+        else:
+            dump.add_from_layout(layout, data)
+        return dump
+
+    def slice_fields():
+        offset = 0
+        for _, width in layout:
+            data[offset:offset + width]
+            offset += width
+
+    yield "slice", slice_fields
+    yield "add_from_layout", decoded
+    yield "add_from_layout_flatten", lambda: decoded(flatten=True)
+
+    for cls, ext in [(CSVDump, ".csv"), (PythonDump, ".py"), (SigrokDump, ".sr"),
+                     (VCDDump, ".vcd"), (BinaryDump, ".dsc")]:
+        filename = os.path.join(directory, "dump" + ext)
+        dump = decoded()
+        yield "write" + ext, lambda: cls(dump).write(filename)
+        yield "read" + ext, lambda: cls().read(filename)
+
+
+def run(depths, widths, only=None, max_cells=2**28):
+    results = []
+    directory = tempfile.mkdtemp(prefix="darkscope-bench-")
+    try:
+        for width in widths:
+            for depth in depths:
+                data = make_capture(depth, width)
+                layout = make_layout(width)
+                for name, fn in benchmarks(data, layout, directory):
+                    if only is not None and name not in only:
+                        continue
+                    result = {"benchmark": name, "depth": depth, "width": width}
+                    if depth*width > max_cells and name not in ["slice", "add_from_layout"]:
+                        result["skipped"] = "larger than --max-cells"
+                    else:
+                        try:
+                            seconds, peak = measure(fn)
+                        except NotImplementedError as e:
+                            result["skipped"] = str(e)
+                        else:
+                            result["seconds"]        = seconds
+                            result["samples_per_s"]  = depth/seconds if seconds else None
+                            result["mbytes_per_s"]   = data.words.nbytes/seconds/1e6 if seconds else None
+                            result["peak_bytes"]     = peak
+                            result["capture_bytes"]  = data.words.nbytes
+                    results.append(result)
+                    print_result(result)
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+def print_result(result, baseline=None):
+    line = "{:<26} depth={:<9} width={:<4}".format(result["benchmark"], result["depth"], result["width"])
+    if "skipped" in result:
+        line += " skipped ({})".format(result["skipped"])
+    else:
+        line += " {:10.4f} s {:12.0f} samples/s {:10.1f} MiB peak".format(
+            result["seconds"], result["samples_per_s"] or 0, result["peak_bytes"]/2**20)
+        if baseline is not None and "seconds" in baseline:
+            line += "  x{:.2f} vs baseline".format(baseline["seconds"]/result["seconds"])
+    print(line)
+
+
+def compare(results, filename):
+    baseline = {}
+    for result in json.load(open(filename))["results"]:
+        baseline[(result["benchmark"], result["depth"], result["width"])] = result
+    print("\nComparison with {}:".format(filename))
+    for result in results:
+        print_result(result, baseline.get((result["benchmark"], result["depth"], result["width"])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="darkscope dump/export benchmarks")
+    parser.add_argument("--depths", default="1000,100000,1000000,10000000",
+                        help="comma separated capture depths (default: %(default)s)")
+    parser.add_argument("--widths", default="1,32,512",
+                        help="comma separated capture widths in bits (default: %(default)s)")
+    parser.add_argument("--only", default=None,
+                        help="comma separated benchmark names to run")
+    parser.add_argument("--max-cells", type=int, default=2**28,
+                        help="skip exports of captures with more depth*width bits (default: %(default)s)")
+    parser.add_argument("-o", "--output", default="bench.json",
+                        help="JSON results file (default: %(default)s)")
+    parser.add_argument("--compare", default=None,
+                        help="previous JSON results file to compare against")
+    args = parser.parse_args()
+
+    depths = [int(d) for d in args.depths.split(",")]
+    widths = [int(w) for w in args.widths.split(",")]
+    only = None if args.only is None else args.only.split(",")
+    results = run(depths, widths, only, args.max_cells)
+
+    meta = {
+        "time":     time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python":   platform.python_version(),
+        "numpy":    np.__version__,
+        "platform": platform.platform(),
+    }
+    with open(args.output, "w") as f:
+        json.dump({"meta": meta, "results": results}, f, indent=1)
+    if args.compare is not None:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,7 @@
 from darkscope.core import DarkScopeAnalyzer
 from darkscope.software.driver.io import DarkScopeIODriver
 from darkscope.software.driver.analyzer import DarkScopeAnalyzerDriver
+from darkscope.software.driver.aio import AsyncDarkScopeAnalyzerDriver
+from darkscope.software.driver.session import DarkScopeSession
+from darkscope.software.driver.stats import DarkScopeStats
+from darkscope.software.driver.sim import SimRegs
@@ -3,6 +3,8 @@
 # This file is Copyright (c) 2016 Tim 'mithro' Ansell <mithro@mithis.com>
 # License: BSD
 
+import os
+
 from nmigen import *
 from nmigen.hdl import *
 from nmigen.hdl.dsl import FSM
@@ -10,7 +12,6 @@ from nmigen.lib.cdc import FFSynchronizer
 from nmigen.lib.fifo import AsyncFIFO as NAsyncFIFO
 from nmigen.utils import bits_for
 
-from .migen_compat import WaitTimer
 
 def write_to_file(filename, contents, force_unix=False):
     newline = None
@@ -39,6 +40,7 @@ class _Trigger(Elaboratable):
 
         self.enable = Signal()
         self.done   = Signal()
+        self.rearm  = Signal() # restart the conditions, in the scope domain
 
         self.mem_write = Signal()
         self.mem_mask  = Signal(data_width)
@@ -53,47 +55,225 @@ class _Trigger(Elaboratable):
         m = Module()
 
         # Control re-synchronization
-        enable   = Signal()
-        enable_d = Signal()
+        enable = Signal()
         m.submodules += FFSynchronizer(self.enable, enable, o_domain="scope")
-        m.d.scope += enable_d.eq(enable)
 
         # Status re-synchronization
         done = Signal()
         m.submodules += FFSynchronizer(done, self.done)
 
-        # Memory and configuration
+        # Memory and configuration: conditions are appended from the bus side
+        # and cleared at once by disabling the trigger.
+        mem = Memory(width=2*self._data_width, depth=self._depth)
+        m.submodules.mem_wrport = wrport = mem.write_port()
+        m.submodules.mem_rdport = rdport = mem.read_port(domain="comb")
+
+        count          = Signal(range(self._depth + 1))
+        enable_d       = Signal()
         mem_write_last = Signal()
-        m.d.sync += mem_write_last.eq(self.mem_write)
-        
-        mem = AsyncFIFO([("mask", self._data_width), ("value", self._data_width)], self._depth)
-        mem = DomainRenamer({"write": "sync", "read": "scope"})(mem)
-        m.submodules += mem
+        m.d.sync += [
+            enable_d.eq(self.enable),
+            mem_write_last.eq(self.mem_write)
+        ]
         m.d.comb += [
-            mem.sink.valid.eq(~mem_write_last & self.mem_write),
-            mem.sink.payload.mask.eq(self.mem_mask),
-            mem.sink.payload.value.eq(self.mem_value),
-            self.mem_full.eq(~mem.sink.ready)
+            self.mem_full.eq(count == self._depth),
+            wrport.addr.eq(count),
+            wrport.data.eq(Cat(self.mem_mask, self.mem_value)),
+            wrport.en.eq(~mem_write_last & self.mem_write & ~self.mem_full)
         ]
-
-        # Hit and memory read/flush
-        hit   = Signal()
-        flush = WaitTimer(2*self._depth)
-        m.submodules += flush
+        with m.If(~self.enable & enable_d):
+            m.d.sync += count.eq(0)
+        with m.Elif(wrport.en):
+            m.d.sync += count.eq(count + 1)
+
+        # Hit and memory read
+        count_s = Signal.like(count)
+        index   = Signal.like(count)
+        hit     = Signal()
+        m.submodules += FFSynchronizer(count, count_s, o_domain="scope")
+        mask  = rdport.data[:self._data_width]
+        value = rdport.data[self._data_width:]
         m.d.comb += [
-            flush.wait.eq(~(~enable & enable_d)), # flush when disabling
-            hit.eq((self.sink.payload.data & mem.source.payload.mask) == mem.source.payload.value),
-            mem.source.ready.eq((enable & hit) | ~flush.done),
+            rdport.addr.eq(index),
+            hit.eq((self.sink.payload.data & mask) == value),
+            # Done when all conditions have been met
+            done.eq(index == count_s)
         ]
+        with m.If(~enable | self.rearm):
+            m.d.scope += index.eq(0)
+        with m.Elif(hit & ~done):
+            m.d.scope += index.eq(index + 1)
 
         # Output
         m.d.comb += [
             self.sink.connect(self.source),
-            # Done when all triggers have been consumed
-            done.eq(~mem.source.valid),
             self.source.payload.hit.eq(done)
         ]
-        
+
+        return m
+
+
+class _Comparators(Elaboratable):
+    """Bank of comparators evaluated in parallel on each sample.
+
+    A comparator matches a level (``data & mask == value``), entering
+    (rising) or leaving (falling) that level, or any change of the masked
+    bits from the previous sample. Enabled comparators are combined with AND
+    or OR (``combine``) and the bank fires on the ``count``-th combined match
+    after the trigger sequence is done, then holds the hit like the trigger.
+
+    Comparators are written through ``sel`` and pulses of ``write`` and are
+    cleared by disabling the trigger. Matching and combination are each
+    registered, adding two cycles of latency.
+    """
+    OFF, LEVEL, RISING, FALLING, CHANGED = range(5)
+
+    def __init__(self, data_width, n=4):
+        self.sink   = sink   = Endpoint(core_layout(data_width))
+        self.source = source = Endpoint(core_layout(data_width))
+
+        self.enable = Signal()
+        self.rearm  = Signal() # restart the occurrence count, in the scope domain
+
+        self.sel     = Signal(range(n))
+        self.mask    = Signal(data_width)
+        self.value   = Signal(data_width)
+        self.mode    = Signal(3)
+        self.write   = Signal()
+        self.combine = Signal() # 0: AND, 1: OR
+        self.count   = Signal(16)
+
+        self._data_width = data_width
+        self._n = n
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # Configuration, cleared with the trigger memory
+        masks  = [Signal(self._data_width, name="mask{}".format(i)) for i in range(self._n)]
+        values = [Signal(self._data_width, name="value{}".format(i)) for i in range(self._n)]
+        modes  = [Signal(3, name="mode{}".format(i)) for i in range(self._n)]
+
+        enable_d   = Signal()
+        write_last = Signal()
+        m.d.sync += [
+            enable_d.eq(self.enable),
+            write_last.eq(self.write)
+        ]
+        with m.If(~self.enable & enable_d):
+            m.d.sync += [mode.eq(self.OFF) for mode in modes]
+        with m.Elif(self.write & ~write_last):
+            with m.Switch(self.sel):
+                for i in range(self._n):
+                    with m.Case(i):
+                        m.d.sync += [
+                            masks[i].eq(self.mask),
+                            values[i].eq(self.value),
+                            modes[i].eq(self.mode)
+                        ]
+
+        # Control re-synchronization
+        enable  = Signal()
+        combine = Signal()
+        count   = Signal.like(self.count)
+        m.submodules += [
+            FFSynchronizer(self.enable, enable, o_domain="scope"),
+            FFSynchronizer(self.combine, combine, o_domain="scope"),
+            FFSynchronizer(self.count, count, o_domain="scope")
+        ]
+
+        # Stages advance together when the output is free
+        advance = Signal()
+        m.d.comb += [
+            advance.eq(~self.source.valid | self.source.ready),
+            self.sink.ready.eq(advance)
+        ]
+
+        # Stage 1: match every comparator against the sample and the delayed copy
+        data       = self.sink.payload.data
+        prev       = Signal(self._data_width)
+        prev_valid = Signal()
+        prev_level = Signal(self._n)
+        level      = Signal(self._n)
+        match      = Signal(self._n)
+        enabled    = Signal(self._n)
+        for i in range(self._n):
+            m.d.comb += [
+                level[i].eq((data & masks[i]) == values[i]),
+                enabled[i].eq(modes[i] != self.OFF)
+            ]
+            with m.Switch(modes[i]):
+                with m.Case(self.LEVEL):
+                    m.d.comb += match[i].eq(level[i])
+                with m.Case(self.RISING):
+                    m.d.comb += match[i].eq(prev_valid & level[i] & ~prev_level[i])
+                with m.Case(self.FALLING):
+                    m.d.comb += match[i].eq(prev_valid & ~level[i] & prev_level[i])
+                with m.Case(self.CHANGED):
+                    m.d.comb += match[i].eq(prev_valid & ((data ^ prev) & masks[i]).any())
+
+        valid1 = Signal()
+        data1  = Signal(self._data_width)
+        hit1   = Signal()
+        match1 = Signal(self._n)
+        with m.If(advance):
+            m.d.scope += [
+                valid1.eq(self.sink.valid),
+                data1.eq(data),
+                hit1.eq(self.sink.payload.hit),
+                match1.eq(match)
+            ]
+        with m.If(~enable):
+            m.d.scope += prev_valid.eq(0)
+        with m.Elif(self.sink.valid & advance):
+            m.d.scope += [
+                prev.eq(data),
+                prev_valid.eq(1),
+                prev_level.eq(level)
+            ]
+
+        # Stage 2: combine, count occurrences and hold the hit
+        active      = Signal()
+        matched     = Signal()
+        occurrences = Signal.like(self.count)
+        fired       = Signal()
+        fire        = Signal()
+        m.d.comb += [
+            active.eq(enabled.any()),
+            matched.eq(hit1 & Mux(combine, (match1 & enabled).any(), (match1 | ~enabled).all())),
+            fire.eq(Mux(active, matched & (occurrences + 1 >= count), hit1))
+        ]
+
+        valid2 = Signal()
+        data2  = Signal(self._data_width)
+        hit2   = Signal()
+        with m.If(advance):
+            m.d.scope += [
+                valid2.eq(valid1),
+                data2.eq(data1),
+                hit2.eq(fired | fire)
+            ]
+        with m.If(~enable | self.rearm):
+            m.d.scope += [
+                occurrences.eq(0),
+                fired.eq(0),
+                # Samples in flight belong to the previous segment
+                hit1.eq(0),
+                hit2.eq(0)
+            ]
+        with m.Elif(valid1 & advance & active & matched & ~fired):
+            m.d.scope += [
+                occurrences.eq(occurrences + 1),
+                fired.eq(fire)
+            ]
+
+        # Output
+        m.d.comb += [
+            self.source.valid.eq(valid2),
+            self.source.payload.data.eq(data2),
+            self.source.payload.hit.eq(hit2)
+        ]
+
         return m
 
 
@@ -128,6 +308,117 @@ class _SubSampler(Elaboratable):
         return m
 
 
+class _Compressor(Elaboratable):
+    """Change-only compression between the subsampler and the storage.
+
+    A sample is only passed on when it differs from the previous one, when
+    the trigger hits or when the run counter saturates. The number of samples
+    skipped since the previous output is sent in the low ``delta_width`` bits
+    of each output word, the sample itself above it.
+    """
+    def __init__(self, data_width, delta_width):
+        self.sink   = sink   = Endpoint(core_layout(data_width))
+        self.source = source = Endpoint(core_layout(data_width + delta_width))
+
+        self.enable = Signal()
+
+        self._data_width  = data_width
+        self._delta_width = delta_width
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # Control re-synchronization
+        enable = Signal()
+        m.submodules += FFSynchronizer(self.enable, enable, o_domain="scope")
+
+        last     = Signal(self._data_width)
+        hit_last = Signal()
+        first    = Signal(reset=1)
+        count    = Signal(self._delta_width)
+        change   = Signal()
+
+        m.d.comb += [
+            change.eq(first |
+                      (self.sink.payload.data != last) |
+                      (self.sink.payload.hit & ~hit_last) |
+                      (count == 2**self._delta_width - 1)),
+            self.source.valid.eq(self.sink.valid & change),
+            self.source.payload.data.eq(Cat(count, self.sink.payload.data)),
+            self.source.payload.hit.eq(self.sink.payload.hit),
+            self.sink.ready.eq(self.source.ready | ~change)
+        ]
+
+        with m.If(~enable):
+            m.d.scope += [
+                first.eq(1),
+                count.eq(0)
+            ]
+        with m.Elif(self.sink.valid & self.sink.ready):
+            m.d.scope += [
+                first.eq(0),
+                last.eq(self.sink.payload.data),
+                hit_last.eq(self.sink.payload.hit)
+            ]
+            with m.If(change):
+                m.d.scope += count.eq(0)
+            with m.Else():
+                m.d.scope += count.eq(count + 1)
+
+        return m
+
+
+class _Timestamper(Elaboratable):
+    """Cycle timestamps stored with each sample, last stage before the storage.
+
+    A cycle counter cleared when the storage is armed is sent in the low
+    ``timestamp_width`` bits of each output word, the sample above it. With
+    ``delta`` the cycles since the previous output are sent instead, so
+    narrow stamps suffice as long as stored samples are less than
+    ``2**timestamp_width`` cycles apart.
+    """
+    def __init__(self, data_width, timestamp_width, delta=False):
+        self.sink   = sink   = Endpoint(core_layout(data_width))
+        self.source = source = Endpoint(core_layout(data_width + timestamp_width))
+
+        self.enable = Signal()
+
+        self._timestamp_width = timestamp_width
+        self._delta = delta
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # Control re-synchronization
+        enable   = Signal()
+        enable_d = Signal()
+        m.submodules += FFSynchronizer(self.enable, enable, o_domain="scope")
+        m.d.scope += enable_d.eq(enable)
+
+        counter = Signal(self._timestamp_width)
+        last    = Signal(self._timestamp_width)
+        stamp   = Signal(self._timestamp_width)
+
+        m.d.comb += [
+            stamp.eq(counter - last if self._delta else counter),
+            self.source.valid.eq(self.sink.valid),
+            self.source.payload.data.eq(Cat(stamp, self.sink.payload.data)),
+            self.source.payload.hit.eq(self.sink.payload.hit),
+            self.sink.ready.eq(self.source.ready)
+        ]
+
+        m.d.scope += counter.eq(counter + 1)
+        with m.If(enable & ~enable_d):
+            m.d.scope += [
+                counter.eq(0),
+                last.eq(0)
+            ]
+        with m.Elif(self.sink.valid & self.sink.ready):
+            m.d.scope += last.eq(counter)
+
+        return m
+
+
 class _Mux(Elaboratable):
     def __init__(self, data_width, n):
         self.sinks  = sinks  = [Endpoint(core_layout(data_width)) for i in range(n)]
@@ -155,8 +446,80 @@ class _Mux(Elaboratable):
         return m
 
 
+def packer_samples(width, bus_width):
+    """Number of samples of a group of the given width packed per readout word."""
+    if bus_width is None or 2*width > bus_width:
+        return 1
+    return bus_width//width
+
+
+class _Packer(Elaboratable):
+    def __init__(self, data_width, depth, bus_width, group_widths):
+        self.sink   = sink   = Endpoint([("data", data_width)])
+        self.source = source = Endpoint([("data", max(data_width, bus_width))])
+
+        self.enable = Signal()
+        self.group  = Signal(bits_for(len(group_widths)))
+        self.length = Signal(bits_for(depth))
+
+        self._bus_width = bus_width
+        self._group_widths = group_widths
+
+    def elaborate(self, platform):
+        m = Module()
+
+        samples = [packer_samples(w, self._bus_width) for w in self._group_widths]
+
+        word      = Signal(len(self.source.payload.data))
+        count     = Signal(range(max(samples) + 1))
+        packed    = Signal(len(self.length)) # samples packed since enabled
+        last      = Signal()
+        full      = Signal()
+
+        # Last sample of the current word for the selected group
+        with m.Switch(self.group):
+            for i, n in enumerate(samples):
+                with m.Case(i):
+                    m.d.comb += last.eq((count == n - 1) | (packed == self.length - 1))
+
+        m.d.comb += [
+            self.sink.ready.eq(~full | ~self.enable),
+            self.source.valid.eq(full),
+            self.source.payload.data.eq(word)
+        ]
+
+        with m.If(~self.enable):
+            m.d.sync += [
+                count.eq(0),
+                full.eq(0),
+                packed.eq(0)
+            ]
+        with m.Elif(self.source.valid & self.source.ready):
+            m.d.sync += [
+                count.eq(0),
+                full.eq(0)
+            ]
+        with m.Elif(self.sink.valid & ~full):
+            # Slots are selected statically per group, no barrel shifter
+            with m.Switch(self.group):
+                for i, (width, n) in enumerate(zip(self._group_widths, samples)):
+                    with m.Case(i):
+                        with m.Switch(count):
+                            for j in range(n):
+                                with m.Case(j):
+                                    m.d.sync += word[j*width:(j+1)*width].eq(self.sink.payload.data[:width])
+            m.d.sync += [
+                count.eq(count + 1),
+                packed.eq(packed + 1),
+                full.eq(last)
+            ]
+
+        return m
+
+
 class _Storage(Elaboratable):
-    def __init__(self, data_width, depth):
+    def __init__(self, data_width, depth, bus_width=None, group_widths=None, segments=1, timestamp_width=32,
+                 read_depth=16):
         self.sink = sink = Endpoint(core_layout(data_width))
 
         self.enable    = Signal()
@@ -165,12 +528,29 @@ class _Storage(Elaboratable):
         self.length    = Signal(bits_for(depth))
         self.offset    = Signal(bits_for(depth))
 
+        # Segmented capture: length and offset apply to each segment
+        self.segments          = Signal(bits_for(segments))
+        self.segment_count     = Signal(bits_for(segments))
+        self.segment_sel       = Signal(range(segments))
+        self.segment_timestamp = Signal(timestamp_width)
+        self.rearm             = Signal() # pulsed in the scope domain when a segment is complete
+
         self.mem_valid = Signal()
-        self.mem_data  = Signal(data_width)
+        self.mem_data  = Signal(data_width if bus_width is None else max(data_width, bus_width))
         self.mem_data_read  = Signal()
-        
+        self.mem_data_re    = Signal() # read strobe from the bus, advances the window
+        self.mem_level      = Signal(range(read_depth + 1)) # words that can be read in a burst
+
+        # Selected group, used to pack narrow samples into bus words
+        self.group = Signal(bits_for(1 if group_widths is None else len(group_widths)))
+
         self._data_width = data_width
         self._depth = depth
+        self._bus_width = bus_width
+        self._group_widths = group_widths
+        self._segments = segments
+        self._timestamp_width = timestamp_width
+        self._read_depth = read_depth
 
     def elaborate(self, platform):
         m = Module()
@@ -181,77 +561,229 @@ class _Storage(Elaboratable):
         m.submodules += FFSynchronizer(self.enable, enable, o_domain="scope")
         m.d.scope += enable_d.eq(enable)
 
-        length = Signal(range(self._depth))
-        offset = Signal(range(self._depth))
+        length   = Signal(range(self._depth + 1))
+        offset   = Signal(range(self._depth))
+        segments = Signal.like(self.segments)
         m.submodules += [
             FFSynchronizer(self.length, length, o_domain="scope"),
-            FFSynchronizer(self.offset, offset, o_domain="scope")
+            FFSynchronizer(self.offset, offset, o_domain="scope"),
+            FFSynchronizer(self.segments, segments, o_domain="scope")
         ]
 
         # Status re-synchronization
-        done = Signal()
-        m.submodules += FFSynchronizer(done, self.done)
+        done     = Signal()
+        captured = Signal.like(self.segment_count)
+        m.submodules += [
+            FFSynchronizer(done, self.done),
+            FFSynchronizer(captured, self.segment_count)
+        ]
 
-        # Memory
-        mem = SyncFIFO([("data", self._data_width)], self._depth, buffered=True)
-        mem = DomainRenamer("scope")(mem)
+        # Circular memory: samples are written continuously once armed, the
+        # trigger address is latched on hit and the window is read back from
+        # the latched address, so arming needs no flush. In segmented mode
+        # each segment is a circular region of length samples.
+        mem = Memory(width=self._data_width, depth=self._depth)
+        m.submodules.mem_wrport = wrport = mem.write_port(domain="scope")
+        m.submodules.mem_rdport = rdport = mem.read_port(domain="scope", transparent=False)
         cdc = AsyncFIFO([("data", self._data_width)], 4)
         cdc = DomainRenamer(
             {"write": "scope", "read": "sync"})(cdc)
-        m.submodules += mem, cdc
+        m.submodules += cdc
+
+        # Window start and trigger timestamp of each segment
+        addr_width = len(Signal(range(self._depth)))
+        seg_mem = Memory(width=addr_width + self._timestamp_width, depth=self._segments)
+        m.submodules.seg_wrport = seg_wrport = seg_mem.write_port(domain="scope")
+        m.submodules.seg_rdport = seg_rdport = seg_mem.read_port(domain="comb")
+        m.submodules.seg_tsport = seg_tsport = seg_mem.read_port(domain="comb")
+        m.d.comb += [
+            seg_tsport.addr.eq(self.segment_sel),
+            self.segment_timestamp.eq(seg_tsport.data[addr_width:])
+        ]
+
+        def next_addr(addr, base):
+            return Mux(addr == base + length - 1, base, addr + 1)
+
+        timestamp = Signal(self._timestamp_width) # cycles since arming
+        trig_time = Signal(self._timestamp_width)
+        seg       = Signal(range(self._segments))
+        base      = Signal(range(self._depth))
+        wr_ptr    = Signal(range(self._depth))
+        trig_addr = Signal(range(self._depth))
+        written   = Signal(range(self._depth + 1)) # samples written in this segment
+        pre       = Signal(range(self._depth))     # samples kept before the trigger
+        post      = Signal(range(self._depth + 1)) # samples written from the trigger
+        start     = Signal(range(self._depth))
+        rd_ptr    = Signal(range(self._depth))
+        rd_base   = Signal(range(self._depth))
+        rd_next   = Signal(range(self._depth + 1))
+        rd_seg    = Signal(range(self._segments))
+        rd_segs   = Signal.like(self.segment_count) # segments left to read
+        rd_count  = Signal(range(self._depth + 1))
+        rd_valid  = Signal()
+        rd_first  = Signal() # first word of the window not read yet
+
+        m.d.scope += timestamp.eq(timestamp + 1)
+        m.d.comb += [
+            wrport.addr.eq(wr_ptr),
+            wrport.data.eq(self.sink.payload.data),
+            start.eq(Mux(trig_addr - base >= pre, trig_addr - pre, trig_addr + length - pre)),
+            seg_wrport.addr.eq(seg),
+            seg_wrport.data.eq(Cat(start, trig_time))
+        ]
+
+        # Readout, from trigger_addr - offset of each segment in turn
+        m.d.comb += [
+            rdport.addr.eq(rd_ptr),
+            rdport.en.eq(~rd_valid | cdc.sink.ready),
+            cdc.sink.valid.eq(rd_valid),
+            cdc.sink.payload.data.eq(rdport.data),
+            seg_rdport.addr.eq(rd_seg)
+        ]
+        with m.If(cdc.sink.valid & cdc.sink.ready):
+            m.d.scope += rd_first.eq(0)
+        with m.If(rdport.en):
+            m.d.scope += rd_valid.eq(rd_count != 0)
+            with m.If(rd_count != 0):
+                m.d.scope += [
+                    rd_ptr.eq(next_addr(rd_ptr, rd_base)),
+                    rd_count.eq(rd_count - 1)
+                ]
+            with m.Elif(rd_segs != 0):
+                m.d.scope += [
+                    rd_ptr.eq(seg_rdport.data[:addr_width]),
+                    rd_base.eq(rd_next),
+                    rd_next.eq(rd_next + length),
+                    rd_seg.eq(rd_seg + 1),
+                    rd_segs.eq(rd_segs - 1),
+                    rd_count.eq(length)
+                ]
 
-        # Flush
-        mem_flush = WaitTimer(self._depth)
-        mem_flush = DomainRenamer("scope")(mem_flush)
-        m.submodules += mem_flush
-        
         # FSM
         with m.FSM(reset="IDLE", domain="scope") as fsm:
             with m.State("IDLE"):
-                m.d.comb += done.eq(1)
-                with m.If(enable & ~enable_d):
-                    m.next = "FLUSH"
+                # Done once the window is on its way to the bus side
+                m.d.comb += done.eq(~rd_first)
                 m.d.comb += self.sink.ready.eq(1)
-                m.d.comb += mem.source.connect(cdc.sink)
-            with m.State("FLUSH"):
-                m.d.comb += self.sink.ready.eq(1),
-                m.d.comb += mem_flush.wait.eq(1)
-                m.d.comb += mem.source.ready.eq(1)
-                with m.If(mem_flush.done):
+                with m.If(enable & ~enable_d):
+                    m.d.scope += [
+                        timestamp.eq(0),
+                        seg.eq(0),
+                        base.eq(0),
+                        wr_ptr.eq(0),
+                        written.eq(0),
+                        captured.eq(0),
+                        rd_segs.eq(0),
+                        rd_count.eq(0),
+                        rd_valid.eq(0),
+                        rd_first.eq(0)
+                    ]
                     m.next = "WAIT"
             with m.State("WAIT"):
-                m.d.comb += self.sink.connect(mem.sink, omit={"hit"})
-                with m.If(self.sink.valid & self.sink.payload.hit):
-                    m.next = "RUN"
-                m.d.comb += mem.source.ready.eq(mem.level >= self.offset)
+                m.d.comb += self.sink.ready.eq(1)
+                with m.If(~enable):
+                    m.next = "IDLE"
+                with m.Elif(self.sink.valid):
+                    m.d.comb += wrport.en.eq(1)
+                    m.d.scope += wr_ptr.eq(next_addr(wr_ptr, base))
+                    with m.If(written != self._depth):
+                        m.d.scope += written.eq(written + 1)
+                    with m.If(self.sink.payload.hit):
+                        m.d.scope += [
+                            trig_addr.eq(wr_ptr),
+                            trig_time.eq(timestamp),
+                            pre.eq(Mux(written < offset, written, offset)),
+                            post.eq(1)
+                        ]
+                        m.next = "RUN"
             with m.State("RUN"):
-                m.d.comb += self.sink.connect(mem.sink, omit={"hit"})
-                with m.If(mem.level >= self.length):
+                m.d.comb += self.sink.ready.eq(1)
+                with m.If(~enable):
                     m.next = "IDLE"
+                with m.Elif(pre + post >= length):
+                    m.d.comb += [
+                        seg_wrport.en.eq(1),
+                        self.rearm.eq(1)
+                    ]
+                    m.d.scope += captured.eq(captured + 1)
+                    with m.If(seg + 1 >= segments):
+                        m.d.scope += [
+                            rd_seg.eq(0),
+                            rd_next.eq(0),
+                            rd_segs.eq(seg + 1),
+                            rd_first.eq(length != 0)
+                        ]
+                        m.next = "IDLE"
+                    with m.Else():
+                        m.d.scope += [
+                            seg.eq(seg + 1),
+                            base.eq(base + length),
+                            wr_ptr.eq(base + length),
+                            written.eq(0)
+                        ]
+                        m.next = "WAIT"
+                with m.Elif(self.sink.valid):
+                    m.d.comb += wrport.en.eq(1)
+                    m.d.scope += [
+                        wr_ptr.eq(next_addr(wr_ptr, base)),
+                        post.eq(post + 1)
+                    ]
 
 
         # Memory read
         mem_data_read_last = Signal()
         m.d.sync += mem_data_read_last.eq(self.mem_data_read)
 
+        mem_data_read = (~mem_data_read_last & self.mem_data_read) | self.mem_data_re
+
+        if self._bus_width is None:
+            source = cdc.source
+        else:
+            packer = _Packer(self._data_width, self._depth, self._bus_width, self._group_widths)
+            m.submodules.packer = packer
+            m.d.comb += [
+                packer.enable.eq(self.enable),
+                packer.group.eq(self.group),
+                packer.length.eq(self.length*Mux(self.segments > 1, self.segments, 1)),
+                packer.sink.valid.eq(cdc.source.valid),
+                packer.sink.payload.data.eq(cdc.source.payload.data),
+                cdc.source.ready.eq(packer.sink.ready)
+            ]
+            source = packer.source
+
+        # Read FIFO: its level is the number of words the bus can read back
+        # to back without checking mem_valid. It is drained while disabled.
+        rd_fifo = SyncFIFO([("data", len(self.mem_data))], self._read_depth)
+        m.submodules.rd_fifo = rd_fifo
         m.d.comb += [
-            self.mem_valid.eq(cdc.source.valid),
-            cdc.source.ready.eq((~mem_data_read_last & self.mem_data_read) | ~self.enable),
-            self.mem_data.eq(cdc.source.payload.data)
+            rd_fifo.sink.valid.eq(source.valid),
+            rd_fifo.sink.payload.data.eq(source.payload.data),
+            source.ready.eq(rd_fifo.sink.ready),
+            self.mem_valid.eq(rd_fifo.source.valid),
+            self.mem_data.eq(rd_fifo.source.payload.data),
+            self.mem_level.eq(rd_fifo.level),
+            rd_fifo.source.ready.eq(mem_data_read | ~self.enable)
         ]
-        
+
         return m
 
 
 class DarkScopeAnalyzer(Elaboratable):
-    def __init__(self, groups, depth, clock_domain="sync", trigger_depth=16, csr_csv=None):
+    def __init__(self, groups, depth, clock_domain="sync", trigger_depth=16, csr_csv=None, bus_width=None,
+                 delta_width=None, segments=1, comparators=0, timestamp_width=None, timestamp_delta=False):
         self.groups = groups = self.format_groups(groups)
         self.depth  = depth
 
         self.data_width = data_width = max([sum([len(s) for s in g]) for g in groups.values()])
 
         self.csr_csv = csr_csv
-        
+        self.bus_width = bus_width
+        self.delta_width = delta_width
+        self.segments = segments
+        self.comparators = comparators
+        self.timestamp_width = timestamp_width
+        self.timestamp_delta = timestamp_delta
+
         self._clock_domain = clock_domain
         self._trigger_depth = trigger_depth
 
@@ -274,16 +806,49 @@ class DarkScopeAnalyzer(Elaboratable):
         # Frontend
         m.submodules.trigger = self.trigger = _Trigger(self.data_width, depth=self._trigger_depth)
         m.submodules.subsampler = self.subsampler = _SubSampler(self.data_width)
+        stages = [self.mux.source, self.trigger, self.subsampler]
+
+        # Parallel comparators, after the trigger sequence
+        if self.comparators:
+            m.submodules.comparators = self.comparator_bank = _Comparators(self.data_width, self.comparators)
+            stages.insert(2, self.comparator_bank)
+            m.d.comb += self.comparator_bank.enable.eq(self.trigger.enable)
+
+        # Change-only compression
+        storage_width = self.data_width
+        if self.delta_width is not None:
+            m.submodules.compressor = self.compressor = _Compressor(self.data_width, self.delta_width)
+            stages.append(self.compressor)
+            storage_width += self.delta_width
+
+        # Cycle timestamps
+        if self.timestamp_width is not None:
+            m.submodules.timestamper = self.timestamper = _Timestamper(storage_width,
+                self.timestamp_width, self.timestamp_delta)
+            stages.append(self.timestamper)
+            storage_width += self.timestamp_width
 
         # Storage
-        m.submodules.storage = self.storage = _Storage(self.data_width, self.depth)
+        group_widths = [sum([len(s) for s in self.groups[i]]) for i in range(len(self.groups))]
+        if self.delta_width is not None:
+            group_widths = [w + self.delta_width for w in group_widths]
+        if self.timestamp_width is not None:
+            group_widths = [w + self.timestamp_width for w in group_widths]
+        m.submodules.storage = self.storage = _Storage(storage_width, self.depth,
+            bus_width=self.bus_width, group_widths=group_widths, segments=self.segments)
+        m.d.comb += [
+            self.storage.group.eq(self.mux.value),
+            self.trigger.rearm.eq(self.storage.rearm)
+        ]
+        if self.comparators:
+            m.d.comb += self.comparator_bank.rearm.eq(self.storage.rearm)
+        if self.delta_width is not None:
+            m.d.comb += self.compressor.enable.eq(self.storage.enable)
+        if self.timestamp_width is not None:
+            m.d.comb += self.timestamper.enable.eq(self.storage.enable)
 
         # Pipeline
-        m.submodules.pipeline = Pipeline(
-            m.submodules.mux.source,
-            m.submodules.trigger,
-            m.submodules.subsampler,
-            m.submodules.storage.sink)
+        m.submodules.pipeline = Pipeline(*stages, self.storage.sink)
         
         return m
 
@@ -313,6 +878,18 @@ class DarkScopeAnalyzer(Elaboratable):
             return ",".join(args) + "\n"
         r = format_line("config", "None", "data_width", str(self.data_width))
         r += format_line("config", "None", "depth", str(self.depth))
+        r += format_line("config", "None", "trigger_depth", str(self._trigger_depth))
+        if self.bus_width is not None:
+            r += format_line("config", "None", "bus_width", str(self.bus_width))
+        if self.delta_width is not None:
+            r += format_line("config", "None", "delta_width", str(self.delta_width))
+        if self.segments > 1:
+            r += format_line("config", "None", "segments", str(self.segments))
+        if self.comparators:
+            r += format_line("config", "None", "comparators", str(self.comparators))
+        if self.timestamp_width is not None:
+            r += format_line("config", "None", "timestamp_width", str(self.timestamp_width))
+            r += format_line("config", "None", "timestamp_delta", str(int(self.timestamp_delta)))
         for i, signals in self.groups.items():
             for s in signals:
                 r += format_line("signal", str(i), vns.get_name(s), str(len(s)))
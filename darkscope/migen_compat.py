@@ -16,8 +16,8 @@ class WaitTimer(Elaboratable):
         with m.If(self.wait):
             with m.If(~self.done):
                 m.d.sync += count.eq(count - 1)
-            with m.Else():
-                m.d.sync += count.eq(count.reset)
+        with m.Else():
+            m.d.sync += count.eq(count.reset)
 
         return m
 
@@ -0,0 +1,67 @@
+# License: BSD
+
+import asyncio
+import functools
+import inspect
+
+from darkscope.software.driver.analyzer import DarkScopeAnalyzerDriver
+
+
+class AsyncDarkScopeAnalyzerDriver(DarkScopeAnalyzerDriver):
+    """asyncio DarkScopeAnalyzerDriver; synchronous registers are accessed in ``executor``.
+
+    Methods of DarkScopeAnalyzerDriver accessing registers return coroutines.
+    """
+    def __init__(self, regs, name, config_csv=None, debug=False, executor=None,
+                 poll_interval=1e-3, poll_max=0.1, poll_backoff=2, timeout=None, stats=None):
+        self.load(regs, name, config_csv, debug, stats)
+        self.executor      = executor
+        self.poll_interval = poll_interval
+        self.poll_max      = poll_max
+        self.poll_backoff  = poll_backoff
+        self.timeout       = timeout
+
+    @classmethod
+    async def create(cls, *args, **kwargs):
+        driver = cls(*args, **kwargs)
+        await driver.disable()
+        return driver
+
+    async def call(self, fn, *args, **kwargs):
+        # Registers may be synchronous or return awaitables
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+    async def execute(self, program):
+        value, error = None, None
+        while True:
+            try:
+                operation = program.send(value) if error is None else program.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                value, error = await self.perform(*operation), None
+            except Exception as e:
+                value, error = None, e
+
+    async def perform(self, kind, *args):
+        if kind == "wait":
+            polls, = args
+            await asyncio.sleep(min(self.poll_interval*self.poll_backoff**polls, self.poll_max))
+            return None
+        return await self.call(super().perform, kind, *args)
+
+    def upload_save(self, filename, samplerate=None, chunk_size=4096, queue_size=8):
+        raise NotImplementedError("upload_save is not supported by the asyncio driver, "
+            "use upload and save")
+
+    async def save(self, filename, samplerate=None, flatten=False, data=None, timestamps=None):
+        await self.call(DarkScopeAnalyzerDriver.save, self, filename, samplerate, flatten,
+            data, timestamps)
+
+    async def save_segments(self, filename, samplerate=None, flatten=False, concatenate=False):
+        await self.call(DarkScopeAnalyzerDriver.save_segments, self, filename, samplerate,
+            flatten, concatenate)
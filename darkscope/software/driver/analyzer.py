@@ -4,18 +4,201 @@
 # License: BSD
 
 import os
-import sys
-
+import queue
+import threading
+import time
+from types import MappingProxyType
 
 from darkscope.software.dump.common import *
 from darkscope.software.dump import *
 
 import csv
 
+import numpy as np
+
+from darkscope.software.driver.stats import NullStats, DarkScopeStats, print_phase, print_progress, print_progress_end
+
+
+class DarkScopeConfig:
+    """Parsed analyzer config CSV.
+
+    ``config`` maps parameter names to values, ``layouts`` maps each group to
+    its tuple of ``(name, width)`` signals and ``fields`` maps each signal name
+    to its ``(offset, mask)`` within the group's sample word. They are shared
+    by the drivers of a config CSV, hence read-only.
+    """
+    def __init__(self, filename):
+        config = {}
+        layouts = {}
+        with open(filename) as f:
+            for t, g, n, v in csv.reader(f, delimiter=',', quotechar='#'):
+                if t == "config":
+                    config[n] = int(v)
+                elif t == "signal":
+                    layouts.setdefault(int(g), []).append((n, int(v)))
+        fields = {}
+        for signals in layouts.values():
+            shift = 0
+            for name, length in signals:
+                fields[name] = (1 << shift, (2**length-1) << shift)
+                shift += length
+        self.config = MappingProxyType(config)
+        self.layouts = MappingProxyType({g: tuple(signals) for g, signals in layouts.items()})
+        self.fields = MappingProxyType(fields)
+        self.programs = {}
+
+    def compile_trigger(self, steps):
+        """Compile a trigger sequence to a tuple of ``(mask, value)`` entries.
+
+        Each step of ``steps`` is one of:
+
+        - ``{field: value, ...}``: all fields equal to their values,
+        - ``("rising", field)`` or ``("falling", field)``: an edge of a
+          one bit field (two entries), optionally followed by a dict of
+          conditions that must hold on both sides of the edge,
+        - ``("value", value, mask)``: a raw condition on the sample word.
+
+        Programs are cached by sequence.
+        """
+        key = tuple(_trigger_key(step) for step in steps)
+        program = self.programs.get(key)
+        if program is None:
+            program = []
+            for step in key:
+                kind = step[0]
+                if kind == "cond":
+                    program.append(self.compile_condition(step[1]))
+                elif kind in ("rising", "falling"):
+                    mask, value = self.compile_condition(step[2])
+                    offset, field_mask = self.field(step[1])
+                    if field_mask != offset:
+                        raise ValueError("Edge on {}, which is not a one bit field".format(step[1]))
+                    edge = [(mask | field_mask, value), (mask | field_mask, value | offset)]
+                    program.extend(edge if kind == "rising" else edge[::-1])
+                elif kind == "value":
+                    program.append((step[2], step[1] & step[2]))
+                else:
+                    raise ValueError("Unknown trigger step {!r}".format(step))
+            program = self.programs[key] = tuple(program)
+        return program
+
+    def compile_comparators(self, comparators):
+        """Compile comparator specs to a tuple of ``(mode, mask, value)`` entries.
+
+        Each comparator of ``comparators`` is one of:
+
+        - ``{field: value, ...}`` or ``("level", {field: value, ...})``: all
+          fields equal to their values,
+        - ``("rising", cond)`` or ``("falling", cond)``: the sample starts or
+          stops matching cond, a dict of conditions or a one bit field,
+        - ``("changed", field)``: any change of a field, or of a list of fields,
+        - ``("value", value, mask)``: a raw condition on the sample word.
+
+        Banks are cached by comparators.
+        """
+        key = ("comparators",) + tuple(_comparator_key(c) for c in comparators)
+        bank = self.programs.get(key)
+        if bank is None:
+            bank = []
+            for kind, *args in key[1:]:
+                if kind in ("rising", "falling") and isinstance(args[0], str):
+                    value, mask = self.field(args[0])
+                    if mask != value:
+                        raise ValueError("Edge on {}, which is not a one bit field".format(args[0]))
+                elif kind in ("level", "rising", "falling"):
+                    mask, value = self.compile_condition(args[0])
+                elif kind == "changed":
+                    mask, value = 0, 0
+                    for name in args[0]:
+                        mask |= self.field(name)[1]
+                elif kind == "value":
+                    kind, mask, value = "level", args[1], args[0] & args[1]
+                else:
+                    raise ValueError("Unknown comparator {!r}".format((kind, *args)))
+                bank.append((COMPARATOR_MODES[kind], mask, value))
+            bank = self.programs[key] = tuple(bank)
+        return bank
+
+    def compile_condition(self, cond):
+        mask, value = 0, 0
+        for name, v in cond:
+            offset, field_mask = self.field(name)
+            if v < 0 or v*offset & ~field_mask:
+                raise ValueError("Value {} does not fit in field {}".format(v, name))
+            value |= offset*v
+            mask |= field_mask
+        return mask, value
+
+    def field(self, name):
+        try:
+            return self.fields[name]
+        except KeyError:
+            raise ValueError("Unknown field {}".format(name)) from None
+
+
+def _trigger_key(step):
+    # Hashable, canonical form of a trigger step
+    if isinstance(step, dict):
+        return ("cond", tuple(sorted(step.items())))
+    kind, *args = step
+    if kind in ("rising", "falling"):
+        cond = args[1] if len(args) > 1 else {}
+        return (kind, args[0], tuple(sorted(cond.items())))
+    return (kind, *args)
+
+
+# Comparator modes of _Comparators
+COMPARATOR_MODES = {"off": 0, "level": 1, "rising": 2, "falling": 3, "changed": 4}
+
+
+def _comparator_key(comparator):
+    # Hashable, canonical form of a comparator
+    if isinstance(comparator, dict):
+        return ("level", tuple(sorted(comparator.items())))
+    kind, *args = comparator
+    if kind in ("level", "rising", "falling"):
+        cond = args[0]
+        return (kind, cond if isinstance(cond, str) else tuple(sorted(cond.items())))
+    if kind == "changed":
+        names = args[0]
+        return (kind, (names,) if isinstance(names, str) else tuple(names))
+    return (kind, *args)
+
+
+_configs = {}
+
+def load_config(filename):
+    """Return the DarkScopeConfig of filename, parsed once per modification."""
+    path = os.path.abspath(filename)
+    mtime = os.stat(path).st_mtime_ns
+    cached = _configs.get(path)
+    if cached is None or cached[0] != mtime:
+        cached = _configs[path] = (mtime, DarkScopeConfig(path))
+    return cached[1]
+
 
 class DarkScopeAnalyzerDriver:
-    def __init__(self, regs, name, config_csv=None, debug=False):
+    """Driver of a DarkScopeAnalyzer behind a register bus.
+
+    ``stats`` (a DarkScopeStats) records phase timings and register traffic;
+    by default nothing is recorded. ``debug`` prints phases and upload
+    progress through the same hooks.
+    """
+    def __init__(self, regs, name, config_csv=None, debug=False, stats=None):
+        self.load(regs, name, config_csv, debug, stats)
+        self.disable()
+
+    def load(self, regs, name, config_csv=None, debug=False, stats=None):
+        if stats is None:
+            stats = DarkScopeStats(print_phase, print_progress, on_progress_end=print_progress_end) if debug else NullStats()
+        self.stats = stats
         self.regs = regs
+        self.bus_width = None
+        self.delta_width = None
+        self.segments = 1
+        self.comparators = 0
+        self.timestamp_width = None
+        self.timestamp_delta = 0
         self.name = name
         self.config_csv = config_csv
         if self.config_csv is None:
@@ -26,113 +209,531 @@ class DarkScopeAnalyzerDriver:
         self.build()
         self.group = 0
         self.data = DumpData(self.data_width)
-
-        # disable trigger and storage
-        self.trigger_enable.write(0)
-        self.storage_enable.write(0)
+        self.timestamps = None if self.timestamp_width is None else DumpData(64) # cycle of each sample
+        self.trigger = {"conditions": []}
+        self.captures = []
+        self.trigger_used = 0 # entries in the trigger memory
+        self.comparators_used = 0 # comparators configured
+        self.trigger_stale = False # entries left by a finished capture
+        self.armed = False
+        self.storage_enabled = False # storage configured by configure_storage
+        self.timeout = None # of wait_done, in seconds
+        self.snapshots = {}
 
     def get_config(self):
-        csv_reader = csv.reader(open(self.config_csv), delimiter=',', quotechar='#')
-        for item in csv_reader:
-            t, g, n, v = item
-            if t == "config":
-                setattr(self, n, int(v))
+        self.config = dict(load_config(self.config_csv).config)
+        for n, v in self.config.items():
+            setattr(self, n, v)
 
     def get_layouts(self):
-        self.layouts = {}
-        csv_reader = csv.reader(open(self.config_csv), delimiter=',', quotechar='#')
-        for item in csv_reader:
-            t, g, n, v = item
-            if t == "signal":
-                try:
-                    self.layouts[int(g)].append((n, int(v)))
-                except:
-                    self.layouts[int(g)] = [(n, int(v))]
+        self.layouts = {g: list(signals) for g, signals in load_config(self.config_csv).layouts.items()}
 
     def build(self):
         for key, value in self.regs.d.items():
             if self.name == key[:len(self.name)]:
                 key = key.replace(self.name + "_", "")
+                if self.stats.enabled:
+                    value = self.stats.register(value)
                 setattr(self, key, value)
-        for signals in self.layouts.values():
-            value = 1
-            for name, length in signals:
-                setattr(self, name + "_o", value)
-                value = value*(2**length)
-        for signals in self.layouts.values():
-            value = 0
-            for name, length in signals:
-                setattr(self, name + "_m", (2**length-1) << value)
-                value += length
+        self.fields = dict(load_config(self.config_csv).fields)
+        for name, (offset, mask) in self.fields.items():
+            setattr(self, name + "_o", offset)
+            setattr(self, name + "_m", mask)
+
+    # Register accesses --------------------------------------------------------------------------
+
+    # Methods accessing registers are written as generators of ("read", register),
+    # ("write", register, value), ("burst", address, length) and ("wait", polls)
+    # operations, performed here in order and awaited by the asyncio driver.
+
+    def execute(self, program):
+        value, error = None, None
+        while True:
+            try:
+                operation = program.send(value) if error is None else program.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                value, error = self.perform(*operation), None
+            except Exception as e:
+                value, error = None, e
+
+    def perform(self, kind, *args):
+        if kind == "read":
+            register, = args
+            return register.read()
+        elif kind == "write":
+            register, value = args
+            return register.write(value)
+        elif kind == "burst":
+            addr, length = args
+            return self.regs.read(addr, length, burst="fixed")
+        elif kind == "wait":
+            # Busy polling
+            return None
+        raise ValueError("Unknown register operation {!r}".format(kind))
+
+    def disable(self):
+        return self.execute(self._disable())
+
+    def _disable(self):
+        # disable trigger and storage, this also clears the trigger memory
+        yield ("write", self.trigger_enable, 0)
+        yield ("write", self.storage_enable, 0)
+        self.storage_enabled = False
+        self.clear_trigger_state()
+
+    def clear_trigger_state(self):
+        # Bookkeeping of a trigger memory that has just been cleared
+        self.trigger_used = 0
+        self.comparators_used = 0
+        self.trigger_stale = False
+        self.trigger["conditions"] = []
+
+    def clear_trigger(self):
+        return self.execute(self._clear_trigger())
+
+    def _clear_trigger(self):
+        # Conditions of a finished capture are cleared by disabling the
+        # trigger before a new program is written.
+        if self.trigger_stale:
+            yield ("write", self.trigger_enable, 0)
+            self.clear_trigger_state()
 
     def configure_group(self, value):
-        self.group = value
-        self.mux_value.write(value)
+        return self.execute(self._configure_group(value))
+
+    def _configure_group(self, value):
+        with self.stats.phase("configure"):
+            self.group = value
+            yield ("write", self.mux_value, value)
 
     def add_trigger(self, value=0, mask=0, cond=None):
-        if self.trigger_mem_full.read():
-            raise ValueError("Trigger memory full, too much conditions")
-        if cond is not None:
-            for k, v in cond.items():
-                value |= getattr(self, k + "_o")*v
-                mask |= getattr(self, k + "_m")
-        self.trigger_mem_mask.write(mask)
-        self.trigger_mem_value.write(value)
-        self.trigger_mem_write.write(1)
+        return self.execute(self._add_trigger(value, mask, cond))
+
+    def _add_trigger(self, value, mask, cond):
+        with self.stats.phase("configure"):
+            yield from self._clear_trigger()
+            if (yield ("read", self.trigger_mem_full)):
+                raise ValueError("Trigger memory full, too much conditions")
+            if cond is not None:
+                for k, v in cond.items():
+                    offset, field_mask = self.fields[k]
+                    value |= offset*v
+                    mask |= field_mask
+            yield from self._write_trigger(mask, value)
+
+    def _write_trigger(self, mask, value):
+        yield ("write", self.trigger_mem_mask, mask)
+        yield ("write", self.trigger_mem_value, value)
+        # The entry is written on the rising edge of mem_write
+        yield ("write", self.trigger_mem_write, 1)
+        yield ("write", self.trigger_mem_write, 0)
+        self.trigger["conditions"].append([mask, value])
+        self.trigger_used += 1
 
     def add_rising_edge_trigger(self, name):
-        self.add_trigger(getattr(self, name + "_o")*0, getattr(self, name + "_m"))
-        self.add_trigger(getattr(self, name + "_o")*1, getattr(self, name + "_m"))
+        return self.add_trigger_sequence(("rising", name))
 
     def add_falling_edge_trigger(self, name):
-        self.add_trigger(getattr(self, name + "_o")*1, getattr(self, name + "_m"))
-        self.add_trigger(getattr(self, name + "_o")*0, getattr(self, name + "_m"))
+        return self.add_trigger_sequence(("falling", name))
+
+    def compile_trigger(self, *steps):
+        return load_config(self.config_csv).compile_trigger(steps)
+
+    def _check_trigger(self, program):
+        # Validate the whole program before writing any entry so a long
+        # sequence never leaves the trigger memory half programmed.
+        depth = self.config.get("trigger_depth")
+        if depth is None:
+            # Older config CSVs do not export trigger_depth
+            if program and (yield ("read", self.trigger_mem_full)):
+                raise ValueError("Trigger memory full, too much conditions")
+        elif self.trigger_used + len(program) > depth:
+            raise ValueError("Trigger program of {} conditions does not fit, {} of {} used".format(
+                len(program), self.trigger_used, depth))
+
+    def add_trigger_sequence(self, *steps):
+        """Compile a trigger sequence (see DarkScopeConfig.compile_trigger) and
+        append it to the trigger memory."""
+        return self.execute(self._add_trigger_sequence(steps))
+
+    def _add_trigger_sequence(self, steps):
+        with self.stats.phase("configure"):
+            program = self.compile_trigger(*steps)
+            yield from self._clear_trigger()
+            yield from self._check_trigger(program)
+            for mask, value in program:
+                yield from self._write_trigger(mask, value)
+
+    def compile_comparators(self, *comparators):
+        return load_config(self.config_csv).compile_comparators(comparators)
+
+    def check_comparators(self, bank):
+        if len(bank) > self.comparators:
+            raise ValueError("{} comparators configured, the analyzer has {}".format(
+                len(bank), self.comparators))
+
+    def comparator_writes(self, bank):
+        # (sel, mode, mask, value) writes of bank, turning off the comparators
+        # left over from a previous configuration
+        writes = [(i, mode, mask, value) for i, (mode, mask, value) in enumerate(bank)]
+        writes += [(i, COMPARATOR_MODES["off"], 0, 0) for i in range(len(bank), self.comparators_used)]
+        return writes
+
+    def record_comparators(self, bank, combine, count):
+        self.comparators_used = len(bank)
+        self.trigger["comparators"] = [list(entry) for entry in bank]
+        self.trigger["combine"] = combine
+        self.trigger["count"] = count
+
+    def configure_comparators(self, *comparators, combine="and", count=1):
+        """Configure the parallel comparator bank (see
+        DarkScopeConfig.compile_comparators).
+
+        Matches of the comparators are combined with ``"and"`` or ``"or"``
+        and the capture triggers on the ``count``-th match once the trigger
+        sequence, if any, is done.
+        """
+        return self.execute(self._configure_comparators(comparators, combine, count))
+
+    def _configure_comparators(self, comparators, combine, count):
+        assert combine in ("and", "or")
+        with self.stats.phase("configure"):
+            bank = self.compile_comparators(*comparators)
+            self.check_comparators(bank)
+            yield from self._clear_trigger()
+            yield from self._write_comparators(bank, combine, count)
+
+    def _write_comparators(self, bank, combine, count):
+        for sel, mode, mask, value in self.comparator_writes(bank):
+            yield ("write", self.comparators_sel, sel)
+            yield ("write", self.comparators_mask, mask)
+            yield ("write", self.comparators_value, value)
+            yield ("write", self.comparators_mode, mode)
+            yield ("write", self.comparators_write, 1)
+            yield ("write", self.comparators_write, 0)
+        yield ("write", self.comparators_combine, combine == "or")
+        yield ("write", self.comparators_count, count)
+        self.record_comparators(bank, combine, count)
 
     def configure_trigger(self, value=0, mask=0, cond=None):
-        self.add_trigger(value, mask, cond)
+        return self.add_trigger(value, mask, cond)
 
     def configure_subsampler(self, value):
-        self.subsampler_value.write(value-1)
+        return self.execute(self._configure_subsampler(value))
+
+    def _configure_subsampler(self, value):
+        with self.stats.phase("configure"):
+            self.trigger["subsampler"] = value
+            yield ("write", self.subsampler_value, value-1)
 
-    def run(self, offset = 0, length = None):
+    def configure_storage(self, offset=0, length=None, segments=1):
+        return self.execute(self._configure_storage(offset, length, segments))
+
+    def _configure_storage(self, offset, length, segments):
+        # With segments, offset and length apply to each segment
         if length is None:
-            length = self.depth
+            length = self.depth//segments
         assert offset < self.depth
-        assert length <= self.depth
-        if self.debug:
-            print("[running]...")
-        self.storage_offset.write(offset)
-        self.storage_length.write(length)
-        self.storage_enable.write(1)
-        self.trigger_enable.write(1)
+        assert segments <= self.segments
+        assert length*segments <= self.depth
+        with self.stats.phase("configure"):
+            # Storage arms on a rising edge of enable
+            yield ("write", self.storage_enable, 0)
+            yield from self._write_storage(offset, length, segments)
+            yield ("write", self.storage_enable, 1)
+            self.storage_enabled = True
+
+    def _write_storage(self, offset, length, segments):
+        self.trigger["offset"] = offset
+        self.trigger["length"] = length
+        yield ("write", self.storage_offset, offset)
+        yield ("write", self.storage_length, length)
+        if self.segments > 1:
+            self.trigger["segments"] = segments
+            yield ("write", self.storage_segments, segments)
+
+    def arm(self):
+        return self.execute(self._arm())
+
+    def _arm(self):
+        with self.stats.phase("arm"):
+            yield ("write", self.trigger_enable, 1)
+        self.armed = True
+
+    def run(self, offset = 0, length = None, segments = 1):
+        return self.execute(self._run(offset, length, segments))
+
+    def _run(self, offset, length, segments):
+        yield from self._configure_storage(offset, length, segments)
+        yield from self._arm()
 
     def done(self):
-        return self.storage_done.read()
+        return self.execute(self._done())
+
+    def _done(self):
+        return self.capture_done((yield ("read", self.storage_done)))
+
+    def capture_done(self, done):
+        if done and self.armed:
+            self.armed = False
+            self.trigger_stale = True
+        return done
+
+    def wait_done(self, timeout=None):
+        return self.execute(self._wait_done(timeout))
+
+    def _wait_done(self, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        with self.stats.phase("wait"):
+            start = time.monotonic()
+            polls = 0
+            while not (yield from self._done()):
+                if timeout is not None and time.monotonic() - start > timeout:
+                    raise TimeoutError("{} capture not done after {}s".format(self.name, timeout))
+                yield ("wait", polls)
+                polls += 1
 
-    def wait_done(self):
-        while not self.done():
-            pass
+    def samples_per_word(self, width):
+        # Must match the readout packer of _Storage
+        if self.bus_width is None or 2*width > self.bus_width:
+            return 1
+        return self.bus_width//width
+
+    def unpack(self, words, width, samples):
+        if samples == 1:
+            if width <= 64:
+                return np.asarray(words, dtype=np.uint64) & np.uint64(2**width - 1)
+            return [word & (2**width - 1) for word in words]
+        words = np.asarray(words, dtype=np.uint64)
+        shifts = np.arange(samples, dtype=np.uint64)*np.uint64(width)
+        return ((words[:, None] >> shifts) & np.uint64(2**width - 1)).ravel()
+
+    def split_timestamps(self, samples):
+        # Stored words hold their timestamp in the low timestamp_width bits
+        if isinstance(samples, np.ndarray) and samples.dtype != object:
+            shift = np.uint64(self.timestamp_width)
+            return samples >> shift, samples & np.uint64(2**self.timestamp_width - 1)
+        samples = np.asarray(list(samples), dtype=object)
+        return samples >> self.timestamp_width, samples & (2**self.timestamp_width - 1)
+
+    def decode(self, samples, previous=None):
+        """Decode stored words to one value per sample and, with timestamps,
+        the cycle of each sample (None without).
+
+        ``previous`` is the ``(value, cycle)`` of the last sample of a
+        previous chunk of the same capture.
+        """
+        value, cycle = (None, None) if previous is None else previous
+        times = None
+        if self.timestamp_width is not None:
+            samples, stamps = self.split_timestamps(samples)
+            times = cycle_times(stamps, self.timestamp_width, self.timestamp_delta, cycle)
+        # Change-only storage: expand words back to one value per sample
+        if self.delta_width is None:
+            return samples, times
+        if times is not None:
+            times = expand_times(times, samples, self.delta_width, cycle)
+        return expand_changes(samples, self.delta_width, value), times
+
+    def expand(self, samples, previous=None):
+        return self.decode(samples, None if previous is None else (previous, None))[0]
+
+    def upload_size(self, length):
+        width = sum(w for _, w in self.layouts[self.group])
+        if self.delta_width is not None:
+            width += self.delta_width
+        if self.timestamp_width is not None:
+            width += self.timestamp_width
+        samples = self.samples_per_word(width)
+        return width, samples, (length + samples - 1)//samples
+
+    def read_words(self, count, start=0, total=None):
+        return self.execute(self._read_words(count, start, total))
+
+    def _read_words(self, count, start=0, total=None):
+        # Words start to total of a longer upload, whose caller ends the
+        # progress, or the whole upload without total.
+        try:
+            return (yield from self._read_burst(count, start, total))
+        finally:
+            if total is None:
+                self.stats.end_progress("upload")
+
+    def _read_burst(self, count, start, total):
+        # Burst readout: mem_data advances on each read, so a burst at its
+        # fixed address returns consecutive words, as many as mem_level says
+        # are ready. The storage is done once the level stays at 0.
+        level = getattr(self, "storage_mem_level", None)
+        if callable(getattr(self.regs, "read", None)) and level is not None and \
+           getattr(self.storage_mem_data, "length", 1) == 1:
+            words = []
+            empty = 0
+            while len(words) < count and empty < 2:
+                n = min((yield ("read", level)), count - len(words))
+                empty = 0 if n else empty + 1
+                if n:
+                    words += (yield ("burst", self.storage_mem_data.addr, n))
+                    self.stats.read(n, n*self.stats.word_bytes)
+                    self.stats.progress("upload", start + len(words), total or count)
+            return words
+        words = []
+        for position in range(1, count + 1):
+            if not (yield ("read", self.storage_mem_valid)):
+                break
+            words.append((yield ("read", self.storage_mem_data)))
+            self.stats.progress("upload", start + position, total or count)
+        return words
+
+    def _segment_timestamps(self):
+        # Trigger time of each captured segment, in cycles from arming
+        if self.segments == 1:
+            return [None]
+        timestamps = []
+        for i in range((yield ("read", self.storage_segment_count))):
+            yield ("write", self.storage_segment_sel, i)
+            timestamps.append((yield ("read", self.storage_segment_timestamp)))
+        return timestamps
+
+    def split_segments(self, samples, length, timestamps):
+        # Segments are expanded separately: each starts with a full sample
+        self.captures = []
+        for i, timestamp in enumerate(timestamps):
+            data = DumpData(self.data_width)
+            values, times = self.decode(samples[i*length:(i+1)*length])
+            data.extend(values)
+            self.data.extend(data)
+            capture = {"timestamp": timestamp, "data": data}
+            if times is not None:
+                capture["timestamps"] = DumpData(64, times.astype(np.uint64))
+                self.timestamps.extend(capture["timestamps"])
+            self.captures.append(capture)
+        if self.segments > 1:
+            self.trigger["timestamps"] = timestamps
 
     def upload(self):
-        if self.debug:
-            print("[uploading]...")
+        return self.execute(self._upload())
+
+    def _upload(self):
+        with self.stats.phase("upload"):
+            length = yield ("read", self.storage_length)
+            timestamps = yield from self._segment_timestamps()
+            total = length*len(timestamps)
+            width, samples, count = self.upload_size(total)
+            words = yield from self._read_words(count)
+        with self.stats.phase("decode"):
+            self.split_segments(self.unpack(words, width, samples)[:total], length, timestamps)
+        return self.data
+
+    def upload_segments(self):
+        """Upload a segmented capture and return its segments.
+
+        Each segment is a dict of its trigger ``timestamp`` (cycles from
+        arming) and its ``data``; ``self.data`` holds them back to back.
+        """
+        return self.execute(self._upload_segments())
+
+    def _upload_segments(self):
+        yield from self._upload()
+        return self.captures
+
+    def upload_save(self, filename, samplerate=None, chunk_size=4096, queue_size=8):
+        """Upload and save at the same time.
+
+        A reader thread uploads chunks of ``chunk_size`` words into a bounded
+        queue while they are decoded and written incrementally (.vcd or .dsc
+        files), so the link and the exporter run in parallel.
+        """
+        name, ext = os.path.splitext(filename)
+        if ext == ".vcd" and self.segments == 1:
+            dump = VCDDump()
+            dump.add_from_layout(self.layouts[self.group], self.data, self.timestamps)
+        elif ext == ".dsc" and self.segments == 1:
+            dump = BinaryDump(data=self.data, layouts=self.layouts, group=self.group,
+                config=self.config, samplerate=samplerate, trigger=self.trigger,
+                timestamps=self.timestamps)
+        else:
+            # Segmented captures are uploaded whole, segment timestamps first
+            self.upload()
+            self.save(filename, samplerate)
+            return self.data
+
         length = self.storage_length.read()
-        for position in range(1, length + 1):
-            if self.debug:
-                sys.stdout.write("|{}>{}| {}%\r".format('=' * (20*position//length),
-                                                        ' ' * (20-20*position//length),
-                                                        100*position//length))
-                sys.stdout.flush()
-            if not self.storage_mem_valid.read():
-                break
-            self.data.append(self.storage_mem_data.read())
-        if self.debug:
-            print("")
+        width, samples, count = self.upload_size(length)
+        chunks = queue.Queue(queue_size)
+        stop = threading.Event()
+
+        def produce():
+            try:
+                for position in range(0, count, chunk_size):
+                    if stop.is_set():
+                        return
+                    n = min(chunk_size, count - position)
+                    with self.stats.phase("upload"):
+                        words = self.read_words(n, position, count)
+                    chunks.put(words)
+                    if len(words) < n:
+                        break
+            except BaseException as e:
+                chunks.put(e)
+            else:
+                chunks.put(None)
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        dump.open(filename)
+        try:
+            remaining = length
+            previous = None
+            while True:
+                words = chunks.get()
+                if words is None:
+                    break
+                if isinstance(words, BaseException):
+                    raise words
+                with self.stats.phase("decode"):
+                    data = self.unpack(words, width, samples)[:remaining]
+                    remaining -= len(data)
+                    if len(data):
+                        values, times = self.decode(data, previous)
+                        previous = (values[-1], None if times is None else times[-1])
+                        self.data.extend(values)
+                        if times is not None:
+                            self.timestamps.extend(times.astype(np.uint64))
+                with self.stats.phase("save"):
+                    dump.update()
+        finally:
+            with self.stats.phase("save"):
+                dump.close()
+            stop.set()
+            while producer.is_alive():
+                try:
+                    chunks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self.stats.end_progress("upload")
         return self.data
 
-    def save(self, filename, samplerate=None, flatten=False):
-        if self.debug:
-            print("[writing to " + filename + "]...")
+    def save(self, filename, samplerate=None, flatten=False, data=None, timestamps=None):
+        if data is None:
+            data, timestamps = self.data, self.timestamps
+        with self.stats.phase("save"):
+            self._save(filename, samplerate, flatten, data, timestamps)
+
+    def save_segments(self, filename, samplerate=None, flatten=False, concatenate=False):
+        """Save each uploaded segment to ``<name>_<n><ext>``, or all of them
+        back to back to filename with concatenate."""
+        if concatenate:
+            DarkScopeAnalyzerDriver.save(self, filename, samplerate, flatten)
+            return
+        name, ext = os.path.splitext(filename)
+        for i, capture in enumerate(self.captures):
+            DarkScopeAnalyzerDriver.save(self, "{}_{}{}".format(name, i, ext), samplerate, flatten,
+                capture["data"], capture.get("timestamps"))
+
+    def _save(self, filename, samplerate, flatten, data, timestamps):
         name, ext = os.path.splitext(filename)
         if ext == ".vcd":
             dump = VCDDump()
@@ -142,23 +743,97 @@ class DarkScopeAnalyzerDriver:
             dump = PythonDump()
         elif ext == ".sr":
             dump = SigrokDump(samplerate=samplerate)
+        elif ext == ".dsc":
+            dump = BinaryDump(data=data, layouts=self.layouts, group=self.group,
+                config=self.config, samplerate=samplerate, trigger=self.trigger,
+                timestamps=timestamps)
+            dump.write(filename)
+            return
         else:
             raise NotImplementedError
         if not flatten:
-            dump.add_from_layout(self.layouts[self.group], self.data)
+            dump.add_from_layout(self.layouts[self.group], data, timestamps)
         else:
-            dump.add_from_layout_flatten(self.layouts[self.group], self.data)
+            dump.add_from_layout_flatten(self.layouts[self.group], data, timestamps)
         dump.write(filename)
 
+    def decode_sample(self, group, sample):
+        """Split a sample of group into a dict of its named fields."""
+        values = {}
+        shift = 0
+        for name, width in self.layouts[group]:
+            values[name] = (sample >> shift) & (2**width - 1)
+            shift += width
+        return values
+
+    def capture_sample(self, group):
+        """Capture and return one sample of group, leaving the driver state as is."""
+        return self.execute(self._capture_sample(group))
+
+    def _capture_sample(self, group):
+        previous, trigger, self.trigger = self.group, self.trigger, {"conditions": []}
+        state = (self.storage_enabled, self.trigger_stale)
+        try:
+            yield from self._disable()
+            yield from self._configure_group(group)
+            yield from self._add_trigger_sequence([("value", 0, 0)])
+            yield from self._configure_subsampler(1)
+            yield from self._run(0, 1, 1)
+            yield from self._wait_done()
+            with self.stats.phase("upload"):
+                width, samples, count = self.upload_size(1)
+                words = yield from self._read_words(count)
+        finally:
+            yield from self._restore(trigger, *state)
+            if previous != group:
+                yield from self._configure_group(previous)
+        if not words:
+            raise ValueError("No sample captured for group {}".format(group))
+        return int(self.expand(self.unpack(words, width, samples)[:1])[0])
+
+    def _restore(self, trigger, storage_enabled, trigger_stale):
+        # Reprogram the configuration of trigger after a sample capture,
+        # without arming the trigger
+        yield from self._disable()
+        self.armed = False
+        self.trigger, conditions = trigger, trigger["conditions"]
+        trigger["conditions"] = []
+        for mask, value in conditions:
+            yield from self._write_trigger(mask, value)
+        if "comparators" in trigger:
+            yield from self._write_comparators(trigger["comparators"], trigger["combine"], trigger["count"])
+        yield ("write", self.subsampler_value, trigger.get("subsampler", 1) - 1)
+        if "offset" in trigger:
+            yield from self._write_storage(trigger["offset"], trigger["length"], trigger.get("segments", 1))
+            if storage_enabled:
+                yield ("write", self.storage_enable, 1)
+                self.storage_enabled = True
+        self.trigger_stale = trigger_stale
+
+    def snapshot(self, groups=None, max_age=0):
+        """Return the current value of every field of groups (all by default).
+
+        One sample is captured per group and decoded in one pass. Groups
+        captured less than ``max_age`` seconds ago are served from the last
+        snapshot instead of being captured again.
+        """
+        return self.execute(self._snapshot(groups, max_age))
+
+    def _snapshot(self, groups, max_age):
+        if groups is None:
+            groups = list(self.layouts)
+        values = {}
+        for group in groups:
+            now = time.monotonic()
+            cached = self.snapshots.get(group)
+            if cached is None or now - cached[0] > max_age:
+                sample = yield from self._capture_sample(group)
+                cached = self.snapshots[group] = (now, self.decode_sample(group, sample))
+            values.update(cached[1])
+        return values
+
     def get_instant_value(self, group, name):
-        self.data = DumpData(self.data_width)
-        self.debug = False
-        self.configure_group(group)
-        self.configure_trigger()
-        self.configure_subsampler(1)
-        self.run(0, 1)
-        self.wait_done()
-        self.upload()
-        min_idx = log2_int(getattr(self, name + "_o"))
-        max_idx = min_idx + log2_int((getattr(self, name + "_m") >> min_idx) + 1)
-        return self.data[min_idx:max_idx][0]
+        return self.execute(self._get_instant_value(group, name))
+
+    def _get_instant_value(self, group, name):
+        return (yield from self._snapshot([group], 0))[name]
@@ -0,0 +1,86 @@
+# License: BSD
+
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from darkscope.software.dump import *
+
+
+class DarkScopeSession:
+    """Capture with several analyzers on the same clock, one worker thread per bridge."""
+    def __init__(self, drivers, poll_interval=1e-3, poll_max=0.1, poll_backoff=2):
+        self.drivers = list(drivers)
+        self.poll_interval = poll_interval
+        self.poll_max      = poll_max
+        self.poll_backoff  = poll_backoff
+
+        self.bridges = OrderedDict()
+        for driver in self.drivers:
+            self.bridges.setdefault(id(driver.regs), []).append(driver)
+
+    def run(self, offset=0, length=None):
+        # Program every storage first so the trigger enables go out back to back.
+        for driver in self.drivers:
+            driver.configure_storage(offset, length)
+        for driver in self.drivers:
+            driver.arm()
+
+    def wait_upload(self, drivers, timeout=None):
+        start = time.monotonic()
+        interval = self.poll_interval
+        pending = list(drivers)
+        while pending:
+            for driver in list(pending):
+                if driver.done():
+                    driver.upload()
+                    pending.remove(driver)
+            if not pending:
+                break
+            if timeout is not None and time.monotonic() - start > timeout:
+                raise TimeoutError("Captures not done after {}s: {}".format(
+                    timeout, ", ".join(driver.name for driver in pending)))
+            time.sleep(interval)
+            interval = min(interval*self.poll_backoff, self.poll_max)
+
+    def wait_done(self, timeout=None):
+        """Wait for every capture and upload it, one worker per bridge."""
+        with ThreadPoolExecutor(max_workers=len(self.bridges)) as executor:
+            futures = [executor.submit(self.wait_upload, drivers, timeout)
+                for drivers in self.bridges.values()]
+            for future in futures:
+                future.result()
+
+    def merge(self):
+        """Return one Dump of every ``<analyzer>_<field>``, aligned on the trigger."""
+        dump = Dump()
+        periods = [driver.trigger.get("subsampler", 1) for driver in self.drivers]
+        triggers = [driver.trigger.get("offset", 0)*period
+            for driver, period in zip(self.drivers, periods)]
+        for driver, period, trigger in zip(self.drivers, periods, triggers):
+            offset = 0
+            for name, sample_width in driver.layouts[driver.group]:
+                values = DumpView(driver.data, offset, offset + sample_width,
+                    repeat=2*period, delay=2*(max(triggers) - trigger))
+                dump.add(DumpVariable(driver.name + "_" + name, sample_width, values))
+                offset += sample_width
+        dump.add(DumpVariable("scope_clk", 1, DumpPattern([1, 0], len(dump))))
+        return dump
+
+    def save(self, filename, samplerate=None):
+        name, ext = os.path.splitext(filename)
+        dump = self.merge()
+        if ext == ".vcd":
+            dump = VCDDump(dump)
+        elif ext == ".csv":
+            dump = CSVDump(dump)
+        elif ext == ".py":
+            dump = PythonDump(dump)
+        elif ext == ".sr":
+            dump = SigrokDump(dump, samplerate=samplerate)
+        elif ext == ".dsc":
+            dump = BinaryDump(dump, samplerate=samplerate)
+        else:
+            raise NotImplementedError
+        dump.write(filename)
@@ -0,0 +1,203 @@
+# License: BSD
+
+from collections import deque
+
+from nmigen.back.pysim import Simulator, Tick
+
+
+class SimRegister:
+    """A CSR of a simulated analyzer, accessed through its SimRegs."""
+    def __init__(self, regs, name, addr, signal, strobe=None):
+        self.regs   = regs
+        self.name   = name
+        self.addr   = addr
+        self.signal = signal
+        self.strobe = strobe # read strobe pulsed after each read
+        self.length = 1
+
+    def read(self):
+        return self.regs.read_register(self)
+
+    def write(self, value):
+        self.regs.write_register(self, value)
+
+
+class _Names:
+    # Stand-in for a netlist namer when exporting the config CSV
+    def get_name(self, signal):
+        return signal.name
+
+
+class SimRegs:
+    """Register bus of a ``DarkScopeAnalyzer`` in the nMigen simulator.
+
+    ``elapsed`` models ``latency`` seconds per transaction plus the bytes moved over ``bandwidth``.
+    """
+    def __init__(self, analyzer, dut=None, name="analyzer", clk_freq=1e6,
+                 latency=0, bandwidth=None, bus_width=32, base=0):
+        self.analyzer  = analyzer
+        self.name      = name
+        self.clk_freq  = clk_freq
+        self.latency   = latency
+        self.bandwidth = bandwidth
+        self.bus_width = bus_width
+
+        self.sim = Simulator(analyzer if dut is None else dut)
+        self.sim.add_clock(1/clk_freq, domain="scope")
+        self.sim.add_clock(1/clk_freq, domain="sync")
+        self.sim.add_process(self._process)
+        self._commands = deque()
+
+        self.d = {}
+        self.registers = {}
+        address = base
+        for csr, signal, strobe in self.get_csrs():
+            register = SimRegister(self, name + "_" + csr, address, signal, strobe)
+            self.d[register.name] = self.registers[address] = register
+            address += 4*self.words(len(signal))
+
+        self.reset_stats()
+
+    def get_csrs(self):
+        trigger    = self.analyzer.trigger
+        subsampler = self.analyzer.subsampler
+        mux        = self.analyzer.mux
+        storage    = self.analyzer.storage
+        csrs = [
+            # name,             signal,              read strobe
+            ("trigger_enable",    trigger.enable,      None),
+            ("trigger_done",      trigger.done,        None),
+            ("trigger_mem_write", trigger.mem_write,   None),
+            ("trigger_mem_mask",  trigger.mem_mask,    None),
+            ("trigger_mem_value", trigger.mem_value,   None),
+            ("trigger_mem_full",  trigger.mem_full,    None),
+            ("subsampler_value",  subsampler.value,    None),
+            ("mux_value",         mux.value,           None),
+            ("storage_enable",    storage.enable,      None),
+            ("storage_done",      storage.done,        None),
+            ("storage_length",    storage.length,      None),
+            ("storage_offset",    storage.offset,      None),
+            ("storage_mem_valid", storage.mem_valid,   None),
+            ("storage_mem_level", storage.mem_level,   None),
+            ("storage_mem_data",  storage.mem_data,    storage.mem_data_re),
+            ("storage_segments",          storage.segments,          None),
+            ("storage_segment_count",     storage.segment_count,     None),
+            ("storage_segment_sel",       storage.segment_sel,       None),
+            ("storage_segment_timestamp", storage.segment_timestamp, None),
+        ]
+        if self.analyzer.comparators:
+            bank = self.analyzer.comparator_bank
+            csrs += [
+                ("comparators_sel",     bank.sel,     None),
+                ("comparators_mask",    bank.mask,    None),
+                ("comparators_value",   bank.value,   None),
+                ("comparators_mode",    bank.mode,    None),
+                ("comparators_write",   bank.write,   None),
+                ("comparators_combine", bank.combine, None),
+                ("comparators_count",   bank.count,   None),
+            ]
+        return csrs
+
+    def export_csv(self, filename):
+        """Write the analyzer config CSV used by the drivers."""
+        self.analyzer.export_csv(_Names(), filename)
+
+    def words(self, width):
+        return (width + self.bus_width - 1)//self.bus_width
+
+    def reset_stats(self):
+        self.stats = {
+            "transactions":  0,
+            "reads":         0,
+            "writes":        0,
+            "bytes_read":    0,
+            "bytes_written": 0,
+            "cycles":        0,
+        }
+
+    @property
+    def elapsed(self):
+        return self.stats["cycles"]/self.clk_freq
+
+    # Bus --------------------------------------------------------------------------------------
+
+    def read_register(self, register):
+        return self.read(register.addr)
+
+    def write_register(self, register, value):
+        self.write(register.addr, value)
+
+    def read(self, addr, length=None, burst="incr"):
+        """Read a register, or ``length`` words in one burst transaction.
+
+        Like the LiteX ``RemoteClient``, bursts read consecutive addresses
+        unless ``burst="fixed"``. Reads never stall: reading
+        ``<name>_storage_mem_data`` returns the current word and pops it only
+        if it is valid.
+        """
+        count = 1 if length is None else length
+        if burst == "fixed":
+            registers = [self.registers[addr]]*count
+        elif burst == "incr":
+            registers = [self.registers[addr + 4*i] for i in range(count)]
+        else:
+            raise ValueError("Unknown burst mode {!r}".format(burst))
+        values = self._execute(self._read(registers))
+        self._account(registers[0], count, "read")
+        return values[0] if length is None else values
+
+    def write(self, addr, value):
+        register = self.registers[addr]
+        self._execute(self._write(register, value))
+        self._account(register, 1, "write")
+
+    def _account(self, register, count, kind):
+        size = count*self.words(len(register.signal))*self.bus_width//8
+        self.stats["transactions"] += 1
+        self.stats[kind + "s"] += count
+        self.stats["bytes_" + ("read" if kind == "read" else "written")] += size
+        cost = self.latency
+        if self.bandwidth is not None:
+            cost += size/self.bandwidth
+        self._execute(self._idle(round(cost*self.clk_freq)))
+
+    # Simulation -------------------------------------------------------------------------------
+
+    def _process(self):
+        while True:
+            if self._commands:
+                command, result = self._commands.popleft()
+                result.append((yield from command))
+            else:
+                yield from self._tick()
+
+    def _tick(self):
+        self.stats["cycles"] += 1
+        yield Tick()
+
+    def _execute(self, command):
+        result = []
+        self._commands.append((command, result))
+        while not result:
+            self.sim.step()
+        return result[0]
+
+    def _idle(self, cycles):
+        for i in range(cycles):
+            yield from self._tick()
+
+    def _read(self, registers):
+        values = []
+        for register in registers:
+            values.append((yield register.signal))
+            if register.strobe is not None:
+                yield register.strobe.eq(1)
+                yield from self._tick()
+                yield register.strobe.eq(0)
+            yield from self._tick()
+        return values
+
+    def _write(self, register, value):
+        # Written values are held, like a CSRStorage
+        yield register.signal.eq(value)
+        yield from self._tick()
@@ -0,0 +1,155 @@
+# License: BSD
+
+import sys
+import threading
+import time
+
+
+class _NullPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class NullStats:
+    """Default driver stats: records nothing, registers are accessed directly."""
+    enabled = False
+    word_bytes = 4
+
+    def phase(self, name):
+        return _null_phase
+
+    def read(self, count=1, size=0):
+        pass
+
+    def write(self, count=1, size=0):
+        pass
+
+    def progress(self, phase, done, total):
+        pass
+
+    def end_progress(self, phase):
+        pass
+
+
+_null_phase = _NullPhase()
+
+
+class _Phase:
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name  = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.stats.add_time(self.name, time.perf_counter() - self.start)
+
+
+class DarkScopeStats(NullStats):
+    """Phase timings (``times``, ``calls``) and register traffic of a driver.
+
+    Counters may be updated from several threads (see upload_save).
+    """
+    enabled = True
+
+    def __init__(self, on_phase=None, on_progress=None, word_bytes=4, on_progress_end=None):
+        self.on_phase        = on_phase
+        self.on_progress     = on_progress
+        self.on_progress_end = on_progress_end
+        self.word_bytes      = word_bytes
+        self.lock            = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.times = {}
+            self.calls = {}
+            self.reads = 0
+            self.writes = 0
+            self.bytes_read = 0
+            self.bytes_written = 0
+            self.progressing = set()
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.times[name] = self.times.get(name, 0) + seconds
+            self.calls[name] = self.calls.get(name, 0) + 1
+        if self.on_phase is not None:
+            self.on_phase(name, seconds)
+
+    def read(self, count=1, size=0):
+        with self.lock:
+            self.reads += count
+            self.bytes_read += size
+
+    def write(self, count=1, size=0):
+        with self.lock:
+            self.writes += count
+            self.bytes_written += size
+
+    def progress(self, phase, done, total):
+        with self.lock:
+            self.progressing.add(phase)
+        if self.on_progress is not None:
+            self.on_progress(phase, done, total)
+
+    def end_progress(self, phase):
+        # Called once a transfer is over, even when it ended early
+        with self.lock:
+            if phase not in self.progressing:
+                return
+            self.progressing.discard(phase)
+        if self.on_progress_end is not None:
+            self.on_progress_end(phase)
+
+    def register(self, register):
+        """Wrap register so its accesses are counted."""
+        return _CountingRegister(register, self)
+
+    def __repr__(self):
+        times = ", ".join("{}={:.6f}s".format(k, v) for k, v in self.times.items())
+        return "DarkScopeStats({}, reads={}, writes={}, bytes_read={}, bytes_written={})".format(
+            times, self.reads, self.writes, self.bytes_read, self.bytes_written)
+
+
+class _CountingRegister:
+    def __init__(self, register, stats):
+        self.register = register
+        self.stats    = stats
+        self.size     = stats.word_bytes*getattr(register, "length", 1)
+
+    def __getattr__(self, attr):
+        return getattr(self.register, attr)
+
+    # Results are returned as is, awaitables included
+    def read(self):
+        self.stats.read(1, self.size)
+        return self.register.read()
+
+    def write(self, value):
+        self.stats.write(1, self.size)
+        return self.register.write(value)
+
+
+def print_phase(name, seconds):
+    print("[{}] {:.3f}s".format(name, seconds))
+
+
+def print_progress(phase, done, total):
+    sys.stdout.write("|{}>{}| {}%\r".format('=' * (20*done//total),
+                                            ' ' * (20-20*done//total),
+                                            100*done//total))
+    sys.stdout.flush()
+
+
+def print_progress_end(phase):
+    sys.stdout.write("\n")
+    sys.stdout.flush()
@@ -1,4 +1,5 @@
-from darkscope.software.dump.common import DumpData, DumpVariable, Dump
+from darkscope.software.dump.common import DumpData, DumpView, DumpBitView, DumpPattern, DumpVariable, Dump, expand_changes, cycle_times, expand_times
+from darkscope.software.dump.binary import BinaryDump
 from darkscope.software.dump.csv import CSVDump
 from darkscope.software.dump.python import PythonDump
 from darkscope.software.dump.sigrok import SigrokDump
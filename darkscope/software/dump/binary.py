@@ -0,0 +1,159 @@
+# License: BSD
+
+import json
+import mmap
+import struct
+
+import numpy as np
+
+from darkscope.software.dump.common import Dump, DumpData, DumpVariable, unpack_bits
+
+
+_MAGIC   = b"DSCAPTUR"
+_VERSION = 1
+_ALIGN   = 64
+
+
+class BinaryDump(Dump):
+    """Lossless capture: a JSON header followed by the raw little-endian uint64 sample words.
+
+    With ``timestamps`` each sample is preceded by its cycle.
+    """
+    def __init__(self, dump=None, data=None, layouts=None, group=0, config=None,
+                 samplerate=None, trigger=None, timestamps=None):
+        Dump.__init__(self)
+        self.variables  = [] if dump is None else dump.variables
+        self.data       = data
+        self.timestamps = timestamps
+        self.layouts    = {} if layouts is None else layouts
+        self.group      = group
+        self.config     = {} if config is None else config
+        self.samplerate = samplerate
+        self.trigger    = {} if trigger is None else trigger
+        self.file       = None
+        self._mmap      = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def generate_header(self, width, length, raw=True):
+        header = {
+            "raw":        raw,
+            "width":      width,
+            "nwords":     max(1, (width + 63)//64),
+            "length":     length,
+            "group":      self.group,
+            "layouts":    {str(k): [[n, w] for n, w in v] for k, v in self.layouts.items()},
+            "config":     self.config,
+            "samplerate": self.samplerate,
+            "trigger":    self.trigger,
+            "timestamps": raw and self.timestamps is not None,
+        }
+        header = json.dumps(header).encode()
+        size = len(_MAGIC) + 8 + len(header)
+        header += b" "*(-size % _ALIGN)
+        return _MAGIC + struct.pack("<II", _VERSION, len(header)) + header
+
+    def generate_data(self, window=65536):
+        # Without raw capture data, variables are packed side by side as the
+        # fields of a single group.
+        width = sum(v.width for v in self.variables)
+        nbytes = max(1, (width + 63)//64)*8
+        for start in range(0, len(self), window):
+            stop = min(start + window, len(self))
+            bits = np.zeros((stop - start, nbytes*8), dtype=np.uint8)
+            offset = 0
+            for variable in self.variables:
+                values = variable.get_window(start, stop)
+                bits[:len(values), offset:offset + variable.width] = unpack_bits(values, variable.width)
+                offset += variable.width
+            yield np.packbits(bits, axis=1, bitorder="little").tobytes()
+
+    def generate_words(self, start=0):
+        words = self.data.words[start:]
+        if self.timestamps is not None:
+            words = np.hstack([self.timestamps.words[start:start + len(words)], words])
+        return np.ascontiguousarray(words, dtype="<u8")
+
+    def open(self, filename):
+        self.file = open(filename, "wb")
+        self.file.write(self.generate_header(self.data.width, None))
+        self.position = 0
+
+    def update(self):
+        self.file.write(self.generate_words(self.position))
+        self.position = len(self.data)
+
+    def close(self):
+        # Finish a streamed capture and release a capture mapped by read; the
+        # data of a read capture is dropped with the mapping, which outlives
+        # close only while arrays taken from that data are still referenced.
+        if self.file is not None:
+            self.update()
+            self.file.close()
+            self.file = None
+        if self._mmap is not None:
+            self.variables  = []
+            self.data       = None
+            self.timestamps = None
+            try:
+                self._mmap.close()
+            except BufferError:
+                pass
+            self._mmap = None
+
+    def write(self, filename):
+        f = open(filename, "wb")
+        if self.data is not None:
+            f.write(self.generate_header(self.data.width, len(self.data)))
+            f.write(self.generate_words())
+        else:
+            self.layouts = {0: [(v.name, v.width) for v in self.variables]}
+            self.group = 0
+            f.write(self.generate_header(sum(v.width for v in self.variables), len(self), raw=False))
+            for chunk in self.generate_data():
+                f.write(chunk)
+        f.close()
+
+    def read(self, filename, group=None):
+        self.close()
+        f = open(filename, "rb")
+        self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        f.close()
+        if self._mmap[:len(_MAGIC)] != _MAGIC:
+            raise ValueError("{} is not a darkscope capture".format(filename))
+        version, size = struct.unpack_from("<II", self._mmap, len(_MAGIC))
+        if version != _VERSION:
+            raise ValueError("Unsupported capture version {}".format(version))
+        offset = len(_MAGIC) + 8
+        header = json.loads(self._mmap[offset:offset + size].decode())
+        offset += size
+
+        self.layouts    = {int(k): [(n, w) for n, w in v] for k, v in header["layouts"].items()}
+        self.group      = header["group"] if group is None else group
+        self.config     = header["config"]
+        self.samplerate = header["samplerate"]
+        self.trigger    = header["trigger"]
+
+        nwords = header["nwords"] + header.get("timestamps", False)
+        length = header["length"]
+        if length is None:
+            length = (len(self._mmap) - offset)//(8*nwords)
+        words = np.frombuffer(self._mmap, dtype="<u8", count=length*nwords,
+                              offset=offset).reshape(length, nwords)
+        self.timestamps = None
+        if header.get("timestamps", False):
+            self.timestamps = DumpData(64, words[:, :1])
+            words = words[:, 1:]
+        self.data = DumpData(header["width"], words)
+        self.variables = []
+        if header["raw"]:
+            self.add_from_layout(self.layouts[self.group], self.data, self.timestamps)
+        else:
+            offset = 0
+            for name, width in self.layouts[self.group]:
+                self.add(DumpVariable(name, width, self.data[offset:offset + width]))
+                offset += width
@@ -2,6 +2,8 @@
 # This file is Copyright (c) 2019 kees.jongenburger <kees.jongenburger@gmail.com>
 # License: BSD
 
+import numpy as np
+
 def dec2bin(d, width=0):
     if d == "x":
         return "x"*width
@@ -15,19 +17,220 @@ def dec2bin(d, width=0):
     return b.zfill(width)
 
 
+def _field_mask(width):
+    return np.uint64((1 << min(width, 64)) - 1)
+
+
+def _get_word_bits(words, low, high):
+    # Extract bits [low:high) (at most 64 of them) from an array of packed
+    # little-endian uint64 words, one row per sample.
+    index, shift = divmod(low, 64)
+    width = high - low
+    r = words[:, index] >> np.uint64(shift)
+    if shift and shift + width > 64:
+        r = r | (words[:, index + 1] << np.uint64(64 - shift))
+    if width < 64:
+        r = r & _field_mask(width)
+    return r
+
+
 def get_bits(values, low, high=None):
-    r = []
     if high is None:
         high = low + 1
-    for val in values:
-        t = (val >> low) & (2**(high - low) - 1)
-        r.append(t)
+    if isinstance(values, DumpData):
+        words = values.words
+    else:
+        words = _pack_words(values, high)
+    return _get_bits(words, low, high)
+
+
+def _get_bits(words, low, high):
+    if high <= low:
+        return np.zeros(len(words), dtype=np.uint64)
+    if high - low <= 64:
+        return _get_word_bits(words, low, high)
+    # Wide fields do not fit in a machine word: assemble them as Python ints.
+    r = np.zeros(len(words), dtype=object)
+    for chunk_low in range(low, high, 64):
+        chunk_high = min(chunk_low + 64, high)
+        chunk = _get_word_bits(words, chunk_low, chunk_high).astype(object)
+        r |= chunk << (chunk_low - low)
     return r
 
 
-class DumpData(list):
-    def __init__(self, width):
+def _pack_words(values, width):
+    # Pack a sequence of (possibly wide) integers into a (n, nwords) uint64 array.
+    nwords = max(1, (width + 63)//64)
+    if isinstance(values, np.ndarray) and values.dtype != object:
+        words = np.zeros((len(values), nwords), dtype=np.uint64)
+        words[:, 0] = values.astype(np.uint64)
+        return words
+    values = np.asarray([int(v) for v in values], dtype=object)
+    words = np.zeros((len(values), nwords), dtype=np.uint64)
+    for i in range(nwords):
+        words[:, i] = ((values >> (64*i)) & (2**64 - 1)).astype(np.uint64)
+    return words
+
+
+def unpack_bits(values, width):
+    """Return the bits of each value as an ``(n, width)`` uint8 array, LSB first."""
+    words = _pack_words(values, width).astype("<u8", copy=False)
+    bits = np.unpackbits(words.view(np.uint8), axis=1, bitorder="little")
+    return bits[:, :width]
+
+
+def expand_changes(words, delta_width, previous=None):
+    """Expand change-only storage words back to one value per sample.
+
+    Each word holds the number of samples skipped since the previous word in
+    its low ``delta_width`` bits and the new value above them; skipped
+    samples repeat the previous value. ``previous`` is the value of the last
+    word of a previous chunk (the first word of a capture has no previous
+    samples).
+    """
+    if isinstance(words, np.ndarray) and words.dtype != object:
+        words  = words.astype(np.uint64, copy=False)
+        deltas = (words & np.uint64(2**delta_width - 1)).astype(np.int64)
+        values = words >> np.uint64(delta_width)
+    else:
+        words  = np.asarray(list(words), dtype=object)
+        deltas = (words & (2**delta_width - 1)).astype(np.int64)
+        values = words >> delta_width
+    if not len(words):
+        return values
+    before = np.empty_like(values)
+    before[1:] = values[:-1]
+    if previous is None:
+        before[0] = 0
+        deltas[0] = 0
+    else:
+        before[0] = previous
+    repeated = np.empty(2*len(values), dtype=values.dtype)
+    repeated[0::2] = before
+    repeated[1::2] = values
+    counts = np.ones(2*len(values), dtype=np.int64)
+    counts[0::2] = deltas
+    return np.repeat(repeated, counts)
+
+
+def cycle_times(stamps, width, delta=False, previous=None):
+    """Return the cycle of each sample from its ``width`` bit hardware stamp.
+
+    Inline stamps are a wrapping cycle counter, delta stamps count the cycles
+    since the previous stored sample; both are unwrapped assuming samples are
+    less than ``2**width`` cycles apart. ``previous`` is the cycle of the last
+    sample of a previous chunk. Without it, inline times start at the first
+    stamp and delta times at 0.
+    """
+    stamps = np.asarray(stamps, dtype=np.int64)
+    if not len(stamps):
+        return stamps
+    if delta:
+        steps = stamps.copy()
+    else:
+        first = stamps[0] if previous is None else previous
+        steps = np.diff(stamps, prepend=first) % 2**width
+    if previous is None:
+        steps[0] = 0
+        previous = 0 if delta else stamps[0]
+    return previous + np.cumsum(steps)
+
+
+def expand_times(times, words, delta_width, previous=None):
+    """Expand the cycles of change-only storage words to one per sample.
+
+    ``words`` and ``previous`` are as for expand_changes, ``previous`` being
+    the cycle of the last sample of a previous chunk here. The skipped
+    samples are spread evenly between the cycles of the stored words around
+    them, which is exact at a fixed sample rate.
+    """
+    times = np.asarray(times, dtype=np.int64)
+    if isinstance(words, np.ndarray) and words.dtype != object:
+        deltas = (words.astype(np.uint64, copy=False) & np.uint64(2**delta_width - 1)).astype(np.int64)
+    else:
+        deltas = (np.asarray(list(words), dtype=object) & (2**delta_width - 1)).astype(np.int64)
+    if not len(times):
+        return times
+    before = np.empty_like(times)
+    before[1:] = times[:-1]
+    if previous is None:
+        before[0] = times[0]
+        deltas[0] = 0
+    else:
+        before[0] = previous
+    counts = deltas + 1
+    index = np.repeat(np.arange(len(times)), counts)
+    step = np.arange(len(index)) - np.repeat(np.cumsum(counts) - counts, counts) + 1
+    return before[index] + (times - before)[index]*step//counts[index]
+
+
+class DumpData:
+    """Capture samples stored as packed uint64 words.
+
+    Samples are kept in a contiguous ``(n, nwords)`` array, one 64-bit word per
+    column for groups wider than 64 bits. Slicing with ``data[low:high]``
+    returns the bit field ``[low:high)`` of every sample as an array.
+    """
+    def __init__(self, width, words=None):
         self.width = width
+        self.nwords = max(1, (width + 63)//64)
+        if words is None:
+            self._words = np.zeros((1024, self.nwords), dtype=np.uint64)
+            self._length = 0
+        else:
+            words = np.asarray(words, dtype=np.uint64)
+            if words.ndim == 1:
+                words = words.reshape(-1, 1)
+            if words.shape[1] != self.nwords:
+                raise ValueError("Expected {} words per sample, got {}".format(
+                    self.nwords, words.shape[1]))
+            self._words = words
+            self._length = len(words)
+
+    @property
+    def words(self):
+        return self._words[:self._length]
+
+    def _reserve(self, length):
+        # Read-only words (e.g. mapped from a file) are copied on first write
+        if length > len(self._words) or not self._words.flags.writeable:
+            words = np.zeros((max(length, 2*self._length, 1024), self.nwords), dtype=np.uint64)
+            words[:self._length] = self._words[:self._length]
+            self._words = words
+
+    def append(self, value):
+        self._reserve(self._length + 1)
+        value = int(value)
+        row = self._words[self._length]
+        for i in range(self.nwords):
+            row[i] = (value >> (64*i)) & (2**64 - 1)
+        self._length += 1
+
+    def extend(self, values):
+        if isinstance(values, DumpData):
+            words = values.words
+        else:
+            words = _pack_words(values, self.width)
+        self._reserve(self._length + len(words))
+        self._words[self._length:self._length + len(words)] = words[:, :self.nwords]
+        self._length += len(words)
+
+    def clear(self):
+        self._length = 0
+
+    def tolist(self):
+        return list(self)
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        if self.nwords == 1:
+            return iter(self.words[:, 0].tolist())
+        return iter(get_bits(self, 0, self.width).tolist())
+
+    def __repr__(self):
+        return "DumpData({}, {})".format(self.width, self.tolist())
 
     def __getitem__(self, key):
         if isinstance(key, int):
@@ -50,11 +253,137 @@ class DumpData(list):
             raise KeyError
 
 
+class DumpView:
+    """Lazy view of the bit field ``[low:high)`` of a DumpData.
+
+    Each sample is repeated ``repeat`` times, after ``delay`` leading zeros.
+    Values are only extracted for the windows that are accessed.
+    """
+    def __init__(self, data, low, high, repeat=1, delay=0):
+        self.data   = data
+        self.low    = low
+        self.high   = high
+        self.repeat = repeat
+        self.delay  = delay
+
+    def get_window(self, start, stop):
+        start, stop, _ = slice(start, stop).indices(len(self))
+        stop  = max(start, stop)
+        zeros = max(0, min(stop, self.delay) - start)
+        start = max(start - self.delay, 0)
+        stop  = stop - self.delay
+        if stop <= start:
+            values = _get_bits(self.data.words[:0], self.low, self.high)
+        else:
+            first = start//self.repeat
+            last  = (stop - 1)//self.repeat + 1
+            values = _get_bits(self.data.words[first:last], self.low, self.high)
+            if self.repeat > 1:
+                values = np.repeat(values, self.repeat)
+            values = values[start - first*self.repeat:stop - first*self.repeat]
+        if zeros:
+            values = np.concatenate([np.zeros(zeros, dtype=values.dtype), values])
+        return values
+
+    def __len__(self):
+        return self.delay + len(self.data)*self.repeat
+
+    def __iter__(self):
+        for start in range(0, len(self), 65536):
+            yield from self.get_window(start, start + 65536).tolist()
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            if key.step is not None:
+                raise KeyError
+            return self.get_window(key.start, key.stop)
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError(key)
+        return int(self.get_window(key, key + 1)[0])
+
+
+class DumpBitView(DumpView):
+    """Lazy bit-serial view of the bit field ``[low:high)`` of a DumpData.
+
+    Each sample expands to ``repeat`` (at least ``high - low``) one-bit values,
+    LSB first, the last bit being held until the next sample.
+    """
+    def __init__(self, data, low, high, repeat=None):
+        DumpView.__init__(self, data, low, high, repeat=high - low if repeat is None else repeat)
+
+    def get_window(self, start, stop):
+        start, stop, _ = slice(start, stop).indices(len(self))
+        if stop <= start:
+            return np.zeros(0, dtype=np.uint64)
+        first = start//self.repeat
+        last  = (stop - 1)//self.repeat + 1
+        values = _get_bits(self.data.words[first:last], self.low, self.high)
+        bits = unpack_bits(values, self.high - self.low)
+        if self.repeat > bits.shape[1]:
+            bits = np.concatenate([bits, np.repeat(bits[:, -1:], self.repeat - bits.shape[1], axis=1)], axis=1)
+        bits = bits.ravel().astype(np.uint64)
+        return bits[start - first*self.repeat:stop - first*self.repeat]
+
+
+class DumpPattern:
+    """Lazy view of ``pattern`` repeated up to ``length`` values.
+
+    ``length`` is either an int or a function returning the current length,
+    for patterns that follow a capture as it grows.
+    """
+    def __init__(self, pattern, length):
+        self.pattern = np.asarray(pattern, dtype=np.uint64)
+        self.length  = length
+
+    def get_window(self, start, stop):
+        start, stop, _ = slice(start, stop).indices(len(self))
+        index = np.arange(start, max(start, stop)) % len(self.pattern)
+        return self.pattern[index]
+
+    def __len__(self):
+        if callable(self.length):
+            return self.length()
+        return self.length
+
+    def __iter__(self):
+        for start in range(0, len(self), 65536):
+            yield from self.get_window(start, start + 65536).tolist()
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            if key.step is not None:
+                raise KeyError
+            return self.get_window(key.start, key.stop)
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError(key)
+        return int(self.pattern[key % len(self.pattern)])
+
+
 class DumpVariable:
     def __init__(self, name, width, values=[]):
         self.name = name
         self.width = width
-        self.values = [int(v)%2**width for v in values]
+        if isinstance(values, (DumpView, DumpPattern)):
+            self.values = values
+        elif isinstance(values, np.ndarray) and values.dtype != object and width <= 64:
+            self.values = values.astype(np.uint64) & _field_mask(width)
+        else:
+            self.values = [int(v)%2**width for v in values]
+
+    def get_window(self, start, stop):
+        """Return values ``[start:stop)`` as an array (object dtype above 64 bits)."""
+        if isinstance(self.values, (DumpView, DumpPattern)):
+            return self.values.get_window(start, stop)
+        values = self.values[start:stop]
+        if isinstance(values, np.ndarray):
+            return values
+        if self.width <= 64:
+            return np.fromiter(values, dtype=np.uint64, count=len(values))
+        return np.asarray(values, dtype=object)
 
     def __len__(self):
         return len(self.values)
@@ -63,32 +392,61 @@ class DumpVariable:
 class Dump:
     def __init__(self):
         self.variables = []
+        self.timestamps = None # cycle of each sample, a DumpData
+        self.period = 1        # dump values per sample
 
     def add(self, variable):
         self.variables.append(variable)
 
-    def add_from_layout(self, layout, variable):
+    def time(self, index):
+        """Time of the dump values at index (an int or an array).
+
+        Without timestamps this is the index itself. With them, the values
+        of each sample start at ``period`` times its cycle, so gaps between
+        subsampled or change-only samples keep their true length.
+        """
+        if self.timestamps is None:
+            return index
+        cycles = self.timestamps.words[index//self.period, 0].astype(np.int64)
+        return self.period*cycles + index % self.period
+
+    def add_from_layout(self, layout, variable, timestamps=None):
+        if not isinstance(variable, DumpData):
+            data = DumpData(sum(sample_width for _, sample_width in layout))
+            data.extend(variable)
+            variable = data
         offset = 0
         for name, sample_width in layout:
-            values = variable[offset:offset+sample_width]
-            values2x = [values[i//2] for i in range(len(values)*2)]
-            self.add(DumpVariable(name, sample_width, values2x))
+            # Each sample is shown twice to fake a clock edge; the views are
+            # only expanded by the exporters, one window at a time.
+            values = DumpView(variable, offset, min(offset+sample_width, variable.width), repeat=2)
+            self.add(DumpVariable(name, sample_width, values))
             offset += sample_width
-        self.add(DumpVariable("scope_clk", 1, [1, 0]*(len(self)//2)))
+        # The clock follows the capture length, even while it is uploaded.
+        clk = DumpPattern([1, 0], lambda: 2*len(variable))
+        self.add(DumpVariable("scope_clk", 1, clk))
+        self.timestamps = timestamps
+        self.period = 2
 
-    def add_from_layout_flatten(self, layout, variable):
+    def add_from_layout_flatten(self, layout, variable, timestamps=None):
+        if not isinstance(variable, DumpData):
+            data = DumpData(sum(sample_width for _, sample_width in layout))
+            data.extend(variable)
+            variable = data
         offset = 0
+        # Every field spans one clock period per sample, e.g. 11110000 for 8-bit
+        # fields, and at least two values so the clock toggles with 1-bit fields.
+        period = max([2] + [sample_width for _, sample_width in layout])
         for name, sample_width in layout:
-            # The samples from the logic analyzer end up in an array of size sample size
-            # and have n (number of channel) bits. The following does a bit slice on the array
-            # elements (implemented above)
-            values = variable[offset:offset+sample_width]
-            values_flatten = [values[i//sample_width] >> (i % sample_width ) & 1 for i in range(len(values)*sample_width)]
-            self.add(DumpVariable(name, 1, values_flatten))
+            # Each sample expands to period one-bit values, LSB first; the
+            # bits are unpacked in bulk by the exporters.
+            values = DumpBitView(variable, offset, min(offset+sample_width, variable.width), period)
+            self.add(DumpVariable(name, 1, values))
             offset += sample_width
-        # the clock.. might need some more love here. the clock pattern probably should be sample_width wide
-        # e.g. 11110000 and not 10101010
-        self.add(DumpVariable("scope_clk", 1, [1, 0]*(len(self)//2)))
+        pattern = [1]*((period + 1)//2) + [0]*(period//2)
+        self.add(DumpVariable("scope_clk", 1, DumpPattern(pattern, lambda: period*len(variable))))
+        self.timestamps = timestamps
+        self.period = period
 
     def __len__(self):
         l = 0
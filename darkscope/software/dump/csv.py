@@ -1,13 +1,21 @@
 # This file is Copyright (c) 2015 Florent Kermarrec <florent@enjoy-digital.fr>
 # License: BSD
 
-from darkscope.software.dump.common import Dump, dec2bin
+import numpy as np
+
+from darkscope.software.dump.common import Dump, DumpVariable, unpack_bits
+
+
+_radixes = {"bin": 2, "hex": 16, "dec": 10}
 
 
 class CSVDump(Dump):
-    def __init__(self, dump=None):
+    def __init__(self, dump=None, radix="bin"):
         Dump.__init__(self)
         self.variables = [] if dump is None else dump.variables
+        if radix not in _radixes:
+            raise ValueError("Unknown radix {}, expected one of {}".format(radix, list(_radixes)))
+        self.radix = radix
 
     def generate_vars(self):
         r = ""
@@ -19,29 +27,82 @@ class CSVDump(Dump):
             r += str(variable.width)
             r += ","
         r += "\n"
+        if self.radix != "bin":
+            r += "# radix=" + self.radix + "\n"
         return r
 
-    def generate_dumpvars(self):
-        r  = ""
-        for i in range(len(self)):
-            for variable in self.variables:
-                try:
-                    variable.current_value = variable.values[i]
-                except:
-                    pass
-                if variable.current_value == "x":
-                    r += "x"
-                else:
-                    r += dec2bin(variable.current_value, variable.width)
-                r += ", "
-            r += "\n"
-        return r
+    def generate_cells(self, values, width):
+        # Format a column of values as fixed-width "<value>, " cells in an
+        # (n, cell width) byte matrix.
+        if self.radix == "bin":
+            digits = unpack_bits(values, width)[:, ::-1] + ord("0")
+        else:
+            ndigits = (width + 3)//4
+            bits = np.zeros((len(values), 4*ndigits), dtype=np.uint8)
+            bits[:, :width] = unpack_bits(values, width)
+            nibbles = bits.reshape(len(values), ndigits, 4) @ np.array([1, 2, 4, 8], dtype=np.uint8)
+            digits = np.frombuffer(b"0123456789abcdef", dtype=np.uint8)[nibbles[:, ::-1]]
+        cells = np.empty((len(values), digits.shape[1] + 2), dtype=np.uint8)
+        cells[:, :-2] = digits
+        cells[:, -2:] = np.frombuffer(b", ", dtype=np.uint8)
+        return cells
+
+    def generate_dumpvars(self, window=65536):
+        # Rows are formatted one window at a time; variables shorter than the
+        # dump keep their last value.
+        last = [0]*len(self.variables)
+        for start in range(0, len(self), window):
+            stop = min(start + window, len(self))
+            columns = []
+            for i, variable in enumerate(self.variables):
+                values = variable.get_window(start, stop)
+                if len(values) < stop - start:
+                    fill = values[-1] if len(values) else last[i]
+                    values = np.concatenate([values, np.full(stop - start - len(values), fill,
+                        dtype=values.dtype)])
+                last[i] = values[-1]
+                columns.append(values)
+            if self.radix == "dec":
+                cells = [["{}, ".format(v) for v in values.tolist()] for values in columns]
+                yield "".join("".join(row) + "\n" for row in zip(*cells))
+            else:
+                cells = [self.generate_cells(values, variable.width)
+                    for values, variable in zip(columns, self.variables)]
+                cells.append(np.full((stop - start, 1), ord("\n"), dtype=np.uint8))
+                yield np.concatenate(cells, axis=1).tobytes().decode()
 
     def write(self, filename):
         f = open(filename, "w")
         f.write(self.generate_vars())
-        f.write(self.generate_dumpvars())
+        for chunk in self.generate_dumpvars():
+            f.write(chunk)
+        f.close()
+
+    def read(self, filename, chunk_size=1 << 20):
+        f = open(filename, "r")
+        names  = f.readline().rstrip("\n").split(",")[:-1]
+        widths = [int(w) for w in f.readline().rstrip("\n").split(",")[:-1]]
+        radix = "bin"
+        columns = [[] for _ in names]
+        lines = f.readlines(chunk_size)
+        if lines and lines[0].startswith("#"):
+            radix = lines.pop(0).split("=")[1].strip()
+        base = _radixes[radix]
+        while lines:
+            cells = [[] for _ in names]
+            for line in lines:
+                for column, cell in zip(cells, line.split(",")):
+                    cell = cell.strip()
+                    column.append(0 if "x" in cell else int(cell, base))
+            for column, values, width in zip(columns, cells, widths):
+                dtype = np.uint64 if width <= 64 else object
+                column.append(np.asarray(values, dtype=dtype))
+            lines = f.readlines(chunk_size)
         f.close()
 
-    def read(self, filename):
-        raise NotImplementedError("CSV files can not (yet) be read, please contribute!")
+        self.radix = radix
+        self.variables = []
+        for name, width, column in zip(names, widths, columns):
+            dtype = np.uint64 if width <= 64 else object
+            values = np.concatenate(column) if column else np.zeros(0, dtype=dtype)
+            self.add(DumpVariable(name, width, values))
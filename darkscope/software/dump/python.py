@@ -14,7 +14,7 @@ class PythonDump(Dump):
         for variable in self.variables:
             r += "\"" + variable.name + "\""
             r += " : "
-            r += str(variable.values)
+            r += str([int(v) for v in variable.values])
             r += ",\n"
         r += "}"
         return r
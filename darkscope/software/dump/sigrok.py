@@ -3,12 +3,14 @@
 
 import os
 import math
-import shutil
 import zipfile
 import re
 from collections import OrderedDict
+from fractions import Fraction
 
-from darkscope.software.dump.common import Dump, DumpVariable
+import numpy as np
+
+from darkscope.software.dump.common import Dump, DumpVariable, unpack_bits
 
 
 class SigrokDump(Dump):
@@ -17,14 +19,21 @@ class SigrokDump(Dump):
         self.variables = [] if dump is None else dump.variables
         self.samplerate = 100e6 if samplerate is None else samplerate
 
-    def write_version(self):
-        f = open("version", "w")
-        f.write("1")
-        f.close()
+    def generate_version(self):
+        return "1"
 
-    def write_metadata(self, name):
-        probe_bits = math.ceil(len(self.variables)/8)*8
-        f = open("metadata", "w")
+    def get_probes(self):
+        probes = []
+        for variable in self.variables:
+            if variable.width == 1:
+                probes.append(variable.name)
+            else:
+                probes.extend("{}[{}]".format(variable.name, i) for i in range(variable.width))
+        return probes
+
+    def generate_metadata(self):
+        probes = self.get_probes()
+        probe_bits = math.ceil(len(probes)/8)*8
         r = """
 [global]
 sigrok version=0.3.0
@@ -38,105 +47,83 @@ unitsize={}
         self.samplerate//1e6*2,
         probe_bits//8
     )
-        for i, variable in enumerate(self.variables):
-            r += "probe{}={}\n".format(i + 1, variable.name)
-        f.write(r)
-        f.close()
-
-    def write_data(self):
-        data_bits = math.ceil(len(self.variables)/8)*8
-        data_len = 0
-        for variable in self.variables:
-            data_len = max(data_len, len(variable))
-        datas = []
-        for i in range(data_len):
-            data = 0
-            for j, variable in enumerate(reversed(self.variables)):
-                data = data << 1
-                try:
-                    data |= variable.values[i] & 0x1 # 1 bit probes
-                except:
-                    pass
-            datas.append(data)
-        f = open("logic-1-1", "wb")
-        for data in datas:
-            f.write(data.to_bytes(data_bits//8, "little"))
-        f.close()
+        for i, probe in enumerate(probes):
+            r += "probe{}={}\n".format(i + 1, probe)
+        return r
 
-    def zip(self, name):
-        f = zipfile.ZipFile(name + ".sr", "w")
-        os.chdir(name)
-        f.write("version")
-        f.write("metadata")
-        f.write("logic-1-1")
-        os.chdir("..")
-        f.close()
+    def generate_data(self, window=65536):
+        # Bit planes are packed one window of samples at a time; multi-bit
+        # variables expand to one probe per bit, LSB first.
+        probe_bits = math.ceil(sum(v.width for v in self.variables)/8)*8
+        for start in range(0, len(self), window):
+            stop = min(start + window, len(self))
+            bits = np.zeros((stop - start, probe_bits), dtype=np.uint8)
+            probe = 0
+            for variable in self.variables:
+                values = variable.get_window(start, stop)
+                if variable.width == 1:
+                    bits[:len(values), probe] = values & 1
+                else:
+                    bits[:len(values), probe:probe + variable.width] = unpack_bits(values, variable.width)
+                probe += variable.width
+            yield np.packbits(bits, axis=1, bitorder="little").tobytes()
 
     def write(self, filename):
         name, ext = os.path.splitext(filename)
-        if os.path.exists(name):
-            shutil.rmtree(name)
-        os.makedirs(name)
-        os.chdir(name)
-        self.write_version()
-        self.write_metadata(name)
-        self.write_data()
-        os.chdir("..")
-        self.zip(name)
-        shutil.rmtree(name)
-
-    def unzip(self, filename, name):
-        f = open(filename, "rb")
-        z = zipfile.ZipFile(f)
-        if os.path.exists(name):
-            shutil.rmtree(name)
-            os.makedirs(name)
-        for file in z.namelist():
-            z.extract(file, name)
-        f.close()
+        with zipfile.ZipFile(name + ".sr", "w") as f:
+            f.writestr("version", self.generate_version())
+            f.writestr("metadata", self.generate_metadata())
+            with f.open("logic-1-1", "w") as logic:
+                for chunk in self.generate_data():
+                    logic.write(chunk)
 
-    def read_metadata(self):
+    def read_metadata(self, metadata):
         probes = OrderedDict()
-        f = open("metadata", "r")
-        for l in f:
-            m = re.search("probe([0-9]+) = (\w+)", l, re.I)
-            if m is not None:
-                index = int(m.group(1))
-                name = m.group(2)
-                probes[name] = index
-            m = re.search("samplerate = ([0-9]+) kHz", l, re.I)
+        config = {}
+        for l in metadata.splitlines():
+            m = re.match(r"\s*probe([0-9]+)\s*=\s*(.+?)\s*$", l, re.I)
             if m is not None:
-                self.samplerate = int(m.group(1))*1000
-            m = re.search("samplerate = ([0-9]+) MHz", l, re.I)
+                probes[int(m.group(1))] = m.group(2)
+                continue
+            m = re.match(r"\s*([\w ]+?)\s*=\s*(.+?)\s*$", l)
             if m is not None:
-                self.samplerate = int(m.group(1))*1000000
-        f.close()
-        return probes
+                config[m.group(1).lower()] = m.group(2)
+        m = re.match(r"([0-9.]+)\s*([kMG]?)Hz", config.get("samplerate", ""), re.I)
+        if m is not None:
+            scale = {"": 1, "k": 10**3, "m": 10**6, "g": 10**9}[m.group(2).lower()]
+            self.samplerate = int(Fraction(m.group(1))*scale)
+        return config, probes
 
-    def read_data(self, name, nprobes):
-        datas = []
-        f = open("logic-1-1", "rb")
-        while True:
-            data = f.read(math.ceil(nprobes/8))
-            if data == bytes('', "utf-8"):
-                break
-            data = int.from_bytes(data, "little")
-            datas.append(data)
-        f.close()
-        return datas
+    def read_data(self, z, capturefile, unitsize):
+        # Captures are either a single capturefile or chunks named
+        # capturefile-1, capturefile-2, ...
+        chunks = []
+        for name in z.namelist():
+            if name == capturefile:
+                chunks.append((0, name))
+            elif name.startswith(capturefile + "-") and name[len(capturefile) + 1:].isdigit():
+                chunks.append((int(name[len(capturefile) + 1:]), name))
+        data = b"".join(z.read(name) for _, name in sorted(chunks))
+        data = np.frombuffer(data, dtype=np.uint8)
+        return data[:len(data) - len(data) % unitsize].reshape(-1, unitsize)
 
     def read(self, filename):
         self.variables = []
-        name, ext = os.path.splitext(filename)
-        self.unzip(filename, name)
-        os.chdir(name)
-        probes = self.read_metadata()
-        datas = self.read_data(name, len(probes.keys()))
-        os.chdir("..")
-        shutil.rmtree(name)
+        with zipfile.ZipFile(filename) as z:
+            config, probes = self.read_metadata(z.read("metadata").decode())
+            nprobes = int(config.get("total probes", max(probes.keys(), default=0)))
+            unitsize = int(config.get("unitsize", math.ceil(nprobes/8)))
+            data = self.read_data(z, config.get("capturefile", "logic-1"), unitsize)
 
-        for k, v in probes.items():
-            probe_data = []
-            for data in datas:
-                probe_data.append((data >> (v-1)) & 0x1)
-            self.add(DumpVariable(k, 1, probe_data))
+        # Probes named name[i] are gathered back into multi-bit variables.
+        variables = OrderedDict()
+        for index, probe in probes.items():
+            m = re.match(r"(.+)\[([0-9]+)\]$", probe)
+            name, bit = (m.group(1), int(m.group(2))) if m is not None else (probe, 0)
+            variables.setdefault(name, []).append((bit, index - 1))
+        for name, bits in variables.items():
+            values = np.zeros(len(data), dtype=np.uint64)
+            for bit, index in bits:
+                probe_data = (data[:, index//8] >> (index % 8)) & 1
+                values |= probe_data.astype(np.uint64) << np.uint64(bit)
+            self.add(DumpVariable(name, max(bit for bit, _ in bits) + 1, values))
@@ -3,7 +3,11 @@
 
 from itertools import count
 import datetime
-from darkscope.software.dump.common import Dump, dec2bin
+import mmap
+
+import numpy as np
+
+from darkscope.software.dump.common import Dump, DumpVariable, dec2bin, unpack_bits
 
 
 def vcd_codes():
@@ -20,30 +24,12 @@ def vcd_codes():
 class VCDDump(Dump):
     def __init__(self, dump=None, timescale="1ps", comment=""):
         Dump.__init__(self)
-        self.variables = [] if dump is None else dump.variables
+        if dump is not None:
+            self.variables  = dump.variables
+            self.timestamps = dump.timestamps
+            self.period     = dump.period
         self.timescale = timescale
         self.comment = comment
-        self.cnt = -1
-
-    def change(self):
-        r = ""
-        c = ""
-        for v in self.variables:
-            try:
-                if v.values[self.cnt + 1] != v.current_value:
-                    c += "b"
-                    c += dec2bin(v.values[self.cnt + 1], v.width)
-                    c += " "
-                    c += v.code
-                    c += "\n"
-            except:
-                pass
-        if c != "":
-            r += "#"
-            r += str(self.cnt+1)
-            r += "\n"
-            r += c
-        return r
 
     def generate_date(self):
         now = datetime.datetime.now()
@@ -96,12 +82,49 @@ class VCDDump(Dump):
         r += "$end\n"
         return r
 
-    def generate_valuechange(self):
-        r = ""
-        for i in range(len(self)):
-            r += self.change()
-            self.cnt += 1
-        return r
+    def generate_valuechange(self, window=65536, final=True, position=0, end=None, last=None):
+        # Value changes are computed one window of samples at a time so memory
+        # use does not depend on the capture length. Streaming writers resume
+        # at position with the last values (updated in place) of the previous
+        # call, so samples can be appended in between.
+        if end is None:
+            end = len(self)
+        if last is None:
+            last = [None]*len(self.variables)
+        for start in range(position, end, window):
+            stop = min(start + window, end)
+            times = []
+            lines = []
+            for i, v in enumerate(self.variables):
+                if len(v) <= start:
+                    continue
+                data = v.get_window(start, stop)
+                change = np.empty(len(data), dtype=bool)
+                change[0] = last[i] is None or data[0] != last[i]
+                change[1:] = data[1:] != data[:-1]
+                last[i] = data[-1]
+                index = np.flatnonzero(change)
+                times.append(self.time(index + start))
+                lines.append(_vcd_lines(data[index], v.width, v.code))
+            if not times:
+                continue
+            times = np.concatenate(times)
+            order = np.argsort(times, kind="stable")
+            times = times[order]
+            lines = np.concatenate(lines)[order]
+            # Interleave a timestamp line before the first change of each time.
+            first = np.flatnonzero(np.diff(times, prepend=-1))
+            r = np.empty(len(lines) + len(first), dtype=object)
+            stamps = first + np.arange(len(first))
+            changes = np.ones(len(r), dtype=bool)
+            changes[stamps] = False
+            r[stamps] = [b"#%d\n" % t for t in times[first].tolist()]
+            r[changes] = lines
+            yield b"".join(r.tolist()).decode()
+        # Mark the end of the capture so trailing unchanged samples survive a
+        # round-trip through read().
+        if final and end:
+            yield "#{}\n".format(self.time(end - 1) + 1)
 
     def __repr__(self):
         r = ""
@@ -112,15 +135,159 @@ class VCDDump(Dump):
         for v in self.variables:
             v.code = next(codegen)
 
-    def write(self, filename):
+    def open(self, filename):
         self.finalize()
-        f = open(filename, "w")
-        f.write(self.generate_date())
-        f.write(self.generate_timescale())
-        f.write(self.generate_vars())
-        f.write(self.generate_dumpvars())
-        f.write(self.generate_valuechange())
-        f.close()
-
-    def read(self, filename):
-        raise NotImplementedError("VCD files can not (yet) be read, please contribute!")
+        self.position = 0
+        self.last = [None]*len(self.variables)
+        self.file = open(filename, "w")
+        self.file.write(self.generate_date())
+        self.file.write(self.generate_timescale())
+        self.file.write(self.generate_vars())
+        self.file.write(self.generate_dumpvars())
+
+    def update(self, final=False):
+        end = len(self)
+        for chunk in self.generate_valuechange(final=final, position=self.position, end=end, last=self.last):
+            self.file.write(chunk)
+        self.position = end
+
+    def close(self):
+        self.update(final=True)
+        self.file.close()
+
+    def write(self, filename):
+        self.open(filename)
+        self.close()
+
+    def read_header(self, header):
+        variables = []
+        scopes = []
+        tokens = iter(header.split())
+        for token in tokens:
+            if token == "$timescale":
+                self.timescale = "".join(_read_until_end(tokens))
+            elif token == "$scope":
+                args = _read_until_end(tokens)
+                # darkscope writes "$scope <timescale> $end" without a scope name.
+                if len(args) >= 2:
+                    scopes.append(args[1])
+                else:
+                    scopes.append(None)
+            elif token == "$upscope" or token == "$unscope":
+                _read_until_end(tokens)
+                if scopes:
+                    scopes.pop()
+            elif token == "$var":
+                args = _read_until_end(tokens)
+                name = ".".join([s for s in scopes if s is not None] + [args[3]])
+                v = DumpVariable(name, int(args[1]))
+                v.code = args[2]
+                variables.append(v)
+            elif token.startswith("$"):
+                _read_until_end(tokens)
+        return variables
+
+    def read_valuechange(self, data, position, codes, start=0, stop=None, block=1 << 24):
+        # Tokenize the value change section in large blocks cut on line
+        # boundaries; only the variables in codes are decoded.
+        changes = {code: ([], []) for code in codes}
+        time = 0
+        changed = False
+        skip = False
+        while position < len(data):
+            end = data.rfind(b"\n", position, position + block) + 1
+            if end <= position or position + block >= len(data):
+                end = data.find(b"\n", position + block) + 1
+                if end <= 0:
+                    end = len(data)
+            tokens = iter(data[position:end].split())
+            position = end
+            for token in tokens:
+                c = token[:1]
+                if skip:
+                    skip = token != b"$end"
+                elif c == b"#":
+                    time = int(token[1:])
+                    changed = False
+                    if stop is not None and time >= stop:
+                        position = len(data)
+                        break
+                elif c == b"$":
+                    skip = token == b"$comment"
+                else:
+                    if c in b"bBrR":
+                        value = token[1:]
+                        code = next(tokens)
+                    else:
+                        value = c
+                        code = token[1:]
+                    changed = True
+                    change = changes.get(code)
+                    if change is not None and c not in b"rR":
+                        value = int(value.translate(_vcd_unknown), 2)
+                        if time <= start and change[0]:
+                            # Only the last value before the window is needed.
+                            change[0][-1] = time
+                            change[1][-1] = value
+                        else:
+                            change[0].append(time)
+                            change[1].append(value)
+        # A final timestamp without changes marks the end of the capture.
+        length = time + 1 if changed else time
+        return changes, length
+
+    def read(self, filename, signals=None, start=0, stop=None):
+        """Read a VCD file.
+
+        Samples are placed on the integer time grid of the file. ``signals``
+        restricts decoding to the named variables and ``start``/``stop`` to a
+        time range, so only the requested part of large files is materialized.
+        """
+        f = open(filename, "rb")
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            definitions = data.find(b"$enddefinitions")
+            if definitions < 0:
+                raise ValueError("{} is not a VCD file".format(filename))
+            body = data.find(b"$end", definitions + len(b"$enddefinitions")) + len(b"$end")
+            variables = self.read_header(data[:body].decode())
+            if signals is not None:
+                variables = [v for v in variables if v.name in signals]
+            codes = set(v.code.encode() for v in variables)
+            changes, length = self.read_valuechange(data, body, codes, start, stop)
+        finally:
+            data.close()
+            f.close()
+        if stop is not None:
+            length = stop
+        grid = np.arange(start, max(start, length))
+        self.variables = []
+        for v in variables:
+            times, values = changes[v.code.encode()]
+            dtype = np.uint64 if v.width <= 64 else object
+            times  = np.asarray(times, dtype=np.int64)
+            values = np.asarray([0] + values, dtype=dtype)
+            index  = np.searchsorted(times, grid, side="right")
+            self.add(DumpVariable(v.name, v.width, values[index]))
+
+
+def _vcd_lines(values, width, code):
+    # Format "b<value> <code>\n" lines for an array of values as bytes objects.
+    code = (" " + code + "\n").encode()
+    line = np.empty((len(values), 1 + width + len(code)), dtype=np.uint8)
+    line[:, 0] = ord("b")
+    line[:, 1:1 + width] = unpack_bits(values, width)[:, ::-1] + ord("0")
+    line[:, 1 + width:] = np.frombuffer(code, dtype=np.uint8)
+    return line.view("S{}".format(line.shape[1])).ravel().astype(object)
+
+
+def _read_until_end(tokens):
+    args = []
+    for token in tokens:
+        if token == "$end":
+            break
+        args.append(token)
+    return args
+
+
+_vcd_unknown = bytes.maketrans(b"xXzZuUwW-", b"000000000")
@@ -33,4 +33,5 @@ setup(
     ],
     packages=find_packages(exclude=("test*", "sim*", "doc*", "examples*")),
     include_package_data=True,
+    install_requires=["numpy"],
 )
@@ -26,6 +26,7 @@ class TestAnalyzer(unittest.TestCase):
             yield dut.submodules.analyzer.trigger.mem_value.eq(0x0010)
             yield dut.submodules.analyzer.trigger.mem_mask.eq(0xffff)
             yield dut.submodules.analyzer.trigger.mem_write.eq(1)
+            yield dut.submodules.analyzer.trigger.enable.eq(1)
 
             # Configure Subsampler
             yield dut.submodules.analyzer.subsampler.value.eq(2)
@@ -48,7 +49,92 @@ class TestAnalyzer(unittest.TestCase):
                 yield Tick()
                 yield dut.submodules.analyzer.storage.mem_data_read.eq(0)
                 yield Tick()
-            self.assertEqual(data, [518 + 3*i for i in range(256)])
+            # Storage records from arming (there is no FLUSH anymore) and the
+            # trigger holds until counter == 0x10: the first sample at or after
+            # it is 17, preceded by the only 4 samples recorded since arming.
+            self.assertEqual(data, [5 + 3*i for i in range(256)])
         sim.add_process(process)
         sim.run()
         
+
+    def test_analyzer_burst(self):
+        dut = Module()
+        counter = Signal(16)
+        dut.d.sync += counter.eq(counter + 1)
+        dut.submodules.analyzer = analyzer = DarkScopeAnalyzer(counter, 512)
+
+        sim = Simulator(dut)
+        sim.add_clock(1e-6, domain="scope")
+        sim.add_clock(1e-6, domain="sync")
+        def process():
+            data = []
+            yield Tick()
+            # Configure Subsampler
+            yield analyzer.subsampler.value.eq(2)
+
+            # Configure Storage
+            yield analyzer.storage.length.eq(256)
+            yield analyzer.storage.offset.eq(8)
+            yield analyzer.storage.enable.eq(1)
+            yield Tick()
+            for i in range(16):
+                yield Tick()
+            # Wait capture
+            while not (yield analyzer.storage.done):
+                yield Tick()
+            yield Tick()
+            # Read captured datas, each read strobe advances to the next sample
+            while (yield analyzer.storage.mem_valid):
+                data.append((yield analyzer.storage.mem_data))
+                yield analyzer.storage.mem_data_re.eq(1)
+                yield Tick()
+                yield analyzer.storage.mem_data_re.eq(0)
+                yield Tick()
+            self.assertEqual(len(data), 256)
+            self.assertEqual(data, [data[0] + 3*i for i in range(256)])
+        sim.add_process(process)
+        sim.run()
+
+    def test_analyzer_packed(self):
+        dut = Module()
+        counter = Signal(8)
+        dut.d.sync += counter.eq(counter + 1)
+        dut.submodules.analyzer = analyzer = DarkScopeAnalyzer(counter, 512, bus_width=32)
+
+        sim = Simulator(dut)
+        sim.add_clock(1e-6, domain="scope")
+        sim.add_clock(1e-6, domain="sync")
+        def process():
+            data = []
+            yield Tick()
+            # Configure Subsampler
+            yield analyzer.subsampler.value.eq(2)
+
+            # Configure Storage
+            yield analyzer.storage.length.eq(254)
+            yield analyzer.storage.offset.eq(8)
+            yield analyzer.storage.enable.eq(1)
+            yield Tick()
+            for i in range(16):
+                yield Tick()
+            # Wait capture
+            while not (yield analyzer.storage.done):
+                yield Tick()
+            # Read captured datas, 4 samples per word
+            for i in range(64):
+                for timeout in range(32):
+                    if (yield analyzer.storage.mem_valid):
+                        break
+                    yield Tick()
+                data.append((yield analyzer.storage.mem_data))
+                yield analyzer.storage.mem_data_re.eq(1)
+                yield Tick()
+                yield analyzer.storage.mem_data_re.eq(0)
+                yield Tick()
+            for i in range(32):
+                yield Tick()
+            self.assertFalse((yield analyzer.storage.mem_valid))
+            samples = [(word >> (8*i)) & 0xff for word in data for i in range(4)][:254]
+            self.assertEqual(samples, [(samples[0] + 3*i) % 256 for i in range(254)])
+        sim.add_process(process)
+        sim.run()
@@ -0,0 +1,481 @@
+# License: BSD
+
+import asyncio
+import os
+import tempfile
+
+import numpy as np
+import unittest
+
+from nmigen import *
+
+from darkscope.software.driver.analyzer import DarkScopeAnalyzerDriver, load_config
+from darkscope.software.driver.aio import AsyncDarkScopeAnalyzerDriver
+from darkscope.software.driver.session import DarkScopeSession
+from darkscope.software.driver.sim import SimRegs
+from darkscope.software.driver.stats import DarkScopeStats
+from darkscope import DarkScopeAnalyzer
+from darkscope.software.dump import BinaryDump
+
+
+config = """config,None,data_width,16
+config,None,depth,64
+config,None,trigger_depth,4
+signal,0,counter,12
+signal,0,flag,4
+"""
+
+
+class Register:
+    def __init__(self, value=0):
+        self.value = value
+
+    def read(self):
+        return self.value
+
+    def write(self, value):
+        self.value = value
+
+
+class FakeRegs:
+    """Stand-in for an analyzer behind a register bus, done after a few polls."""
+    def __init__(self, name, polls=3):
+        self.d = {}
+        for reg in ["trigger_enable", "trigger_mem_full", "trigger_mem_mask", "trigger_mem_value",
+                    "trigger_mem_write", "subsampler_value", "mux_value", "storage_enable",
+                    "storage_offset", "storage_length", "storage_mem_valid"]:
+            self.d[name + "_" + reg] = Register()
+        self.d[name + "_storage_done"] = done = Register()
+        self.d[name + "_storage_mem_data"] = data = Register()
+        self.d[name + "_storage_mem_valid"].value = 1
+        self.polls = polls
+        done.read = self.read_done
+        data.read = self.read_data
+        self.samples = iter(range(1 << 16))
+
+    def read_done(self):
+        self.polls -= 1
+        return int(self.polls <= 0)
+
+    def read_data(self):
+        return next(self.samples)
+
+
+class AsyncRegister(Register):
+    async def read(self):
+        return self.value
+
+    async def write(self, value):
+        self.value = value
+
+
+class TestDriver(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.config_csv = os.path.join(self.tmpdir.name, "analyzer.csv")
+        with open(self.config_csv, "w") as f:
+            f.write(config)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_driver(self):
+        driver = DarkScopeAnalyzerDriver(FakeRegs("analyzer"), "analyzer", config_csv=self.config_csv)
+        self.assertEqual(driver.counter_m, 0x0fff)
+        self.assertEqual(driver.flag_o, 1 << 12)
+        driver.run(length=16)
+        driver.wait_done()
+        self.assertEqual(list(driver.upload()), list(range(16)))
+
+    def test_config_cache(self):
+        first = DarkScopeAnalyzerDriver(FakeRegs("analyzer"), "analyzer", config_csv=self.config_csv)
+        second = DarkScopeAnalyzerDriver(FakeRegs("analyzer"), "analyzer", config_csv=self.config_csv)
+        # Drivers get their own copies of the cached config
+        self.assertEqual(first.layouts, second.layouts)
+        self.assertIsNot(first.layouts, second.layouts)
+        first.layouts[0].append(("extra", 1))
+        self.assertEqual(second.layouts[0], [("counter", 12), ("flag", 4)])
+        self.assertEqual(load_config(self.config_csv).layouts[0], (("counter", 12), ("flag", 4)))
+        with self.assertRaises(TypeError):
+            load_config(self.config_csv).fields["extra"] = (1, 1)
+        self.assertEqual(first.fields["flag"], (1 << 12, 0xf000))
+        self.assertIs(first.storage_done, first.regs.d["analyzer_storage_done"])
+        with self.assertRaises(AttributeError):
+            first.missing_o
+        stat = os.stat(self.config_csv)
+        with open(self.config_csv, "a") as f:
+            f.write("signal,1,other,8\n")
+        os.utime(self.config_csv, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+        self.assertEqual(load_config(self.config_csv).layouts[1], (("other", 8),))
+
+    def test_trigger_sequence(self):
+        driver = DarkScopeAnalyzerDriver(FakeRegs("analyzer"), "analyzer", config_csv=self.config_csv)
+        program = driver.compile_trigger({"counter": 5, "flag": 2}, ("value", 0x1234, 0xff00))
+        self.assertEqual(program, ((0xffff, 0x2005), (0xff00, 0x1200)))
+        self.assertIs(driver.compile_trigger({"flag": 2, "counter": 5}, ("value", 0x1234, 0xff00)), program)
+        with self.assertRaises(ValueError):
+            driver.compile_trigger({"flag": 16})
+        with self.assertRaises(ValueError):
+            driver.compile_trigger(("rising", "flag"))
+        with self.assertRaises(ValueError):
+            driver.compile_trigger({"missing": 0})
+
+        driver.add_trigger_sequence({"counter": 5}, {"counter": 6}, {"counter": 7})
+        self.assertEqual(driver.trigger_used, 3)
+        # Too long: nothing is written
+        with self.assertRaises(ValueError):
+            driver.add_trigger_sequence({"counter": 8}, {"counter": 9})
+        self.assertEqual(driver.regs.d["analyzer_trigger_mem_value"].value, 7)
+        self.assertEqual(len(driver.trigger["conditions"]), 3)
+        # The trigger memory is free again once a capture is done
+        driver.run(length=16)
+        driver.wait_done()
+        driver.add_trigger_sequence({"counter": 8}, {"counter": 9})
+        self.assertEqual(driver.trigger_used, 2)
+        self.assertEqual(driver.trigger["conditions"], [[0x0fff, 8], [0x0fff, 9]])
+
+    def test_snapshot(self):
+        driver = DarkScopeAnalyzerDriver(FakeRegs("analyzer"), "analyzer", config_csv=self.config_csv)
+        driver.configure_trigger(cond={"flag": 1})
+        trigger = driver.trigger
+        self.assertEqual(driver.snapshot(), {"counter": 0, "flag": 0})
+        self.assertEqual(driver.snapshot(max_age=60), {"counter": 0, "flag": 0})
+        self.assertEqual(driver.get_instant_value(0, "counter"), 1)
+        self.assertIs(driver.trigger, trigger)
+        self.assertEqual(len(driver.data), 0)
+
+        dut = Module()
+        counter = Signal(16, name="counter")
+        high = Signal(8, name="high")
+        dut.d.sync += counter.eq(counter + 1)
+        dut.d.comb += high.eq(counter[8:])
+        dut.submodules.analyzer = analyzer = DarkScopeAnalyzer({0: [counter], 1: [high]}, 64)
+        regs = SimRegs(analyzer, dut)
+        regs.export_csv(self.config_csv)
+        driver = DarkScopeAnalyzerDriver(regs, "analyzer", config_csv=self.config_csv)
+        for i in range(2):
+            values = driver.snapshot()
+            self.assertEqual(set(values), {"counter", "high"})
+            self.assertLess(abs(values["high"] - (values["counter"] >> 8)), 2)
+            self.assertEqual(driver.group, 0)
+
+        # The configuration of a pending capture survives a snapshot
+        driver.add_trigger_sequence(("value", 0x00, 0x3e))
+        driver.configure_subsampler(2)
+        driver.configure_storage(offset=8, length=32)
+        driver.snapshot()
+        self.assertEqual(driver.trigger["conditions"], [[0x3e, 0x00]])
+        driver.arm()
+        driver.wait_done()
+        data = list(driver.upload())
+        self.assertEqual(data, list(range(data[0], data[0] + 64, 2)))
+        self.assertIn(0, [d & 0x3e for d in data[:16]])
+
+    def test_compressed(self):
+        for bus_width in [None, 32]:
+            dut = Module()
+            counter = Signal(16, name="counter")
+            slow = Signal(8, name="slow")
+            dut.d.sync += counter.eq(counter + 1)
+            dut.d.comb += slow.eq(counter[4:12])
+            dut.submodules.analyzer = analyzer = DarkScopeAnalyzer(slow, 16,
+                bus_width=bus_width, delta_width=8)
+            regs = SimRegs(analyzer, dut)
+            regs.export_csv(self.config_csv)
+            driver = DarkScopeAnalyzerDriver(regs, "analyzer", config_csv=self.config_csv)
+            driver.configure_trigger(cond={"slow": 20})
+            driver.configure_subsampler(1)
+            driver.run(offset=4, length=16)
+            driver.wait_done()
+            data = list(driver.upload())
+            # 16 words hold 14 full runs of 16 samples
+            self.assertEqual(len(data), 14*16 + 1)
+            self.assertEqual(data, [data[0] + i//16 for i in range(len(data))])
+            self.assertIn(20, data)
+
+    def test_stats(self):
+        phases = []
+        progress = []
+        stats = DarkScopeStats(on_phase=lambda name, seconds: phases.append(name),
+            on_progress=lambda phase, done, total: progress.append(done),
+            on_progress_end=lambda phase: progress.append(phase))
+        driver = DarkScopeAnalyzerDriver(FakeRegs("analyzer"), "analyzer",
+            config_csv=self.config_csv, stats=stats)
+        driver.configure_trigger(cond={"flag": 1})
+        driver.run(length=16)
+        driver.wait_done()
+        driver.upload()
+        self.assertEqual(phases, ["configure", "configure", "arm", "wait", "upload", "decode"])
+        self.assertEqual(progress, list(range(1, 17)) + ["upload"])
+        # trigger_mem_full, storage_done (3 polls), storage_length, then
+        # storage_mem_valid and storage_mem_data for each sample
+        self.assertEqual(stats.reads, 1 + 3 + 1 + 2*16)
+        # enables on init, 4 trigger (mem_write set and cleared) and 5 storage registers
+        self.assertEqual(stats.writes, 2 + 4 + 5)
+        self.assertEqual(stats.bytes_read, 4*stats.reads)
+
+        # The progress also ends when the storage runs out of words early
+        progress.clear()
+        driver.storage_mem_valid.read = lambda: len(progress) < 4
+        driver.run(length=16)
+        driver.wait_done()
+        driver.upload()
+        self.assertEqual(progress, [1, 2, 3, 4, "upload"])
+
+    def test_upload_save(self):
+        for ext in [".vcd", ".dsc"]:
+            stream = os.path.join(self.tmpdir.name, "stream" + ext)
+            dump = os.path.join(self.tmpdir.name, "dump" + ext)
+            driver = DarkScopeAnalyzerDriver(FakeRegs("analyzer"), "analyzer", config_csv=self.config_csv)
+            driver.run(length=50)
+            driver.wait_done()
+            driver.upload_save(stream, chunk_size=7, queue_size=2)
+            self.assertEqual(list(driver.data), list(range(50)))
+            driver.save(dump)
+            if ext == ".vcd":
+                self.assertEqual(open(stream).read().split("$timescale")[1],
+                    open(dump).read().split("$timescale")[1])
+            else:
+                with BinaryDump() as binary:
+                    binary.read(stream)
+                    self.assertEqual(list(binary.data), list(range(50)))
+
+    def test_async_driver(self):
+        async def capture(regs):
+            driver = await AsyncDarkScopeAnalyzerDriver.create(regs, "analyzer",
+                config_csv=self.config_csv, poll_interval=1e-4)
+            await driver.configure_trigger(cond={"flag": 1})
+            await driver.run(length=16)
+            await driver.wait_done(timeout=1)
+            return list(await driver.upload())
+
+        regs = FakeRegs("analyzer")
+        self.assertEqual(asyncio.run(capture(regs)), list(range(16)))
+        self.assertEqual(regs.d["analyzer_trigger_mem_mask"].value, 0xf000)
+
+        regs = FakeRegs("analyzer")
+        for name, reg in regs.d.items():
+            regs.d[name] = AsyncRegister(reg.value)
+        regs.d["analyzer_storage_done"].value = 1
+        async def read_data():
+            return regs.read_data()
+        regs.d["analyzer_storage_mem_data"].read = read_data
+        self.assertEqual(asyncio.run(capture(regs)), list(range(16)))
+
+        async def snapshot(regs, stats):
+            driver = await AsyncDarkScopeAnalyzerDriver.create(regs, "analyzer",
+                config_csv=self.config_csv, poll_interval=1e-4, stats=stats)
+            with self.assertRaises(NotImplementedError):
+                driver.upload_save(os.path.join(self.tmpdir.name, "dump.vcd"))
+            return await driver.snapshot()
+
+        stats = DarkScopeStats()
+        self.assertEqual(asyncio.run(snapshot(regs, stats)), {"counter": 16, "flag": 0})
+        self.assertGreater(stats.reads, 0)
+
+    def test_async_driver_timeout(self):
+        async def capture():
+            driver = AsyncDarkScopeAnalyzerDriver(FakeRegs("analyzer", polls=1 << 30), "analyzer",
+                config_csv=self.config_csv, poll_interval=1e-4, poll_max=1e-3)
+            await driver.run()
+            await driver.wait_done(timeout=0.05)
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(capture())
+
+    def test_session(self):
+        drivers = []
+        for name, polls in [("analyzer", 3), ("other", 5)]:
+            config_csv = os.path.join(self.tmpdir.name, name + ".csv")
+            if name != "analyzer":
+                with open(config_csv, "w") as f:
+                    f.write(config)
+            drivers.append(DarkScopeAnalyzerDriver(FakeRegs(name, polls), name, config_csv=config_csv))
+        session = DarkScopeSession(drivers, poll_interval=1e-4)
+        drivers[0].configure_storage(offset=2, length=8)
+        drivers[1].configure_storage(offset=5, length=8)
+        for driver in drivers:
+            driver.arm()
+        session.wait_done(timeout=1)
+        dump = session.merge()
+        self.assertEqual([v.name for v in dump.variables],
+            ["analyzer_counter", "analyzer_flag", "other_counter", "other_flag", "scope_clk"])
+        # Both triggers (sample 2 and sample 5) land on time step 10
+        self.assertEqual(dump.variables[0].values[10], 2)
+        self.assertEqual(dump.variables[2].values[10], 5)
+        self.assertEqual(len(dump.variables[0]), 22)
+        self.assertEqual(len(dump.variables[2]), 16)
+        self.assertEqual(len(dump), 22)
+
+    def test_sim_regs(self):
+        for latency in [0, 10e-6]:
+            dut = Module()
+            counter = Signal(16, name="counter")
+            dut.d.sync += counter.eq(counter + 1)
+            dut.submodules.analyzer = analyzer = DarkScopeAnalyzer(counter, 64)
+            regs = SimRegs(analyzer, dut, latency=latency)
+            regs.export_csv(self.config_csv)
+            driver = DarkScopeAnalyzerDriver(regs, "analyzer", config_csv=self.config_csv)
+            driver.configure_trigger(cond={"counter": 0x100})
+            driver.configure_subsampler(1)
+            driver.run(offset=8, length=32)
+            driver.wait_done()
+            bursts = []
+            read = regs.read
+            def burst_read(addr, length=None, burst="incr"):
+                if length is not None:
+                    bursts.append((length, burst))
+                return read(addr, length, burst)
+            regs.read = burst_read
+            data = list(driver.upload())
+            self.assertEqual(data, list(range(data[0], data[0] + 32)))
+            self.assertIn(0x100, data[:16])
+            # A few bursts at the fixed mem_data address, each of at most the
+            # words in the read FIFO, upload the whole capture
+            self.assertEqual(sum(length for length, _ in bursts), 32)
+            self.assertEqual({burst for _, burst in bursts}, {"fixed"})
+            self.assertLessEqual(max(length for length, _ in bursts), 16)
+            self.assertLessEqual(len(bursts), 4)
+            del regs.read
+            self.assertGreaterEqual(regs.elapsed, latency*regs.stats["transactions"])
+
+            # Back to back capture, re-armed right away
+            driver.add_trigger_sequence(("value", 0x80, 0xff))
+            driver.run(offset=8, length=32)
+            driver.wait_done()
+            data = list(driver.upload())[32:]
+            self.assertEqual(data, list(range(data[0], data[0] + 32)))
+            self.assertIn(0x80, [d & 0xff for d in data[:16]])
+
+            # Every entry of a sequence reaches the trigger memory
+            driver.add_trigger_sequence(("value", 0x10, 0xff), ("value", 0x20, 0xff))
+            driver.run(offset=8, length=32)
+            driver.wait_done()
+            data = [d & 0xff for d in list(driver.upload())[64:]]
+            self.assertIn(0x20, data[:16])
+            self.assertNotIn(0x10, data[:16])
+
+    def test_segments(self):
+        dut = Module()
+        counter = Signal(16, name="counter")
+        dut.d.sync += counter.eq(counter + 1)
+        dut.submodules.analyzer = analyzer = DarkScopeAnalyzer(counter, 64, segments=4)
+        regs = SimRegs(analyzer, dut)
+        regs.export_csv(self.config_csv)
+        driver = DarkScopeAnalyzerDriver(regs, "analyzer", config_csv=self.config_csv)
+        self.assertEqual(driver.segments, 4)
+        driver.add_trigger_sequence(("value", 0x00, 0x3f))
+        driver.configure_subsampler(1)
+        driver.run(offset=4, length=16, segments=4)
+        driver.wait_done()
+        segments = driver.upload_segments()
+        self.assertEqual(len(segments), 4)
+        self.assertEqual(len(driver.data), 64)
+        timestamps = [s["timestamp"] for s in segments]
+        self.assertEqual(timestamps, sorted(timestamps))
+        for segment in segments:
+            data = list(segment["data"])
+            self.assertEqual(data, list(range(data[0], data[0] + 16)))
+            self.assertIn(0, [d & 0x3f for d in data[:4]])
+        # Segments trigger on successive matches, timestamps count cycles
+        starts = [list(s["data"])[0] for s in segments]
+        self.assertEqual([b - a for a, b in zip(starts, starts[1:])],
+                         [b - a for a, b in zip(timestamps, timestamps[1:])])
+        self.assertEqual(starts[1] - starts[0], 64)
+        self.assertEqual(driver.trigger["timestamps"], timestamps)
+
+        with tempfile.TemporaryDirectory() as d:
+            driver.save_segments(os.path.join(d, "dump.csv"))
+            self.assertEqual(sorted(os.listdir(d)), ["dump_{}.csv".format(i) for i in range(4)])
+            driver.save_segments(os.path.join(d, "all.vcd"), concatenate=True)
+            self.assertTrue(os.path.exists(os.path.join(d, "all.vcd")))
+
+    def test_comparators(self):
+        dut = Module()
+        counter = Signal(16, name="counter")
+        toggle = Signal(name="toggle")
+        dut.d.sync += counter.eq(counter + 1)
+        dut.d.comb += toggle.eq(counter[2])
+        dut.submodules.analyzer = analyzer = DarkScopeAnalyzer([counter, toggle], 64, comparators=2)
+        regs = SimRegs(analyzer, dut)
+        regs.export_csv(self.config_csv)
+        driver = DarkScopeAnalyzerDriver(regs, "analyzer", config_csv=self.config_csv)
+        self.assertEqual(driver.comparators, 2)
+        self.assertEqual(driver.compile_comparators(("rising", "toggle"), ("changed", ["counter"])),
+                         ((2, 1 << 16, 1 << 16), (4, 0xffff, 0)))
+        with self.assertRaises(ValueError):
+            driver.compile_comparators(("rising", "counter"))
+        with self.assertRaises(ValueError):
+            driver.configure_comparators({"toggle": 0}, {"toggle": 1}, {"counter": 0})
+        driver.configure_subsampler(1)
+
+        def capture(*comparators, **kwargs):
+            driver.configure_comparators(*comparators, **kwargs)
+            driver.run(offset=0, length=4)
+            armed = regs.stats["cycles"]
+            driver.wait_done()
+            n = len(driver.data)
+            driver.upload()
+            # The trigger sample is the first one of the capture
+            return [d & 0xffff for d in list(driver.data)[n:]], armed
+
+        # Occurrence counter
+        for count in [1, 3]:
+            data, armed = capture(("value", 0x00, 0x0f), count=count)
+            self.assertEqual(data, list(range(data[0], data[0] + 4)))
+            self.assertEqual(data[0] % 16, 0)
+            self.assertIn(data[0] - armed, range((count - 1)*16, count*16 + 4))
+
+        # Edges and levels, combined
+        data, armed = capture(("rising", "toggle"), ("value", 0x40, 0xf0))
+        self.assertEqual(data[0] & 0xff, 0x44)
+        now = regs.stats["cycles"]
+        data, armed = capture({"counter": now + 0x100}, {"counter": now + 0x80}, combine="or")
+        self.assertEqual(data[0], now + 0x80)
+        data, armed = capture(("falling", "toggle"))
+        self.assertEqual(data[0] % 8, 0)
+        data, armed = capture(("changed", "toggle"), count=2)
+        self.assertEqual(data[0] % 4, 0)
+        self.assertIn(data[0] - armed, range(4, 12))
+        self.assertEqual(driver.trigger["comparators"], [[4, 1 << 16, 0]])
+        self.assertEqual(driver.trigger["count"], 2)
+
+    def test_timestamps(self):
+        # Inline stamps with subsampling, delta stamps with change-only storage
+        for kwargs, subsampler in [({"timestamp_width": 16}, 4),
+                                   ({"timestamp_width": 6, "timestamp_delta": True, "delta_width": 4}, 1)]:
+            dut = Module()
+            counter = Signal(16, name="counter")
+            slow = Signal(13, name="slow")
+            dut.d.sync += counter.eq(counter + 1)
+            dut.d.comb += slow.eq(counter[3:])
+            compressed = "delta_width" in kwargs
+            dut.submodules.analyzer = analyzer = DarkScopeAnalyzer(slow if compressed else counter, 64, **kwargs)
+            regs = SimRegs(analyzer, dut)
+            regs.export_csv(self.config_csv)
+            driver = DarkScopeAnalyzerDriver(regs, "analyzer", config_csv=self.config_csv)
+            driver.configure_subsampler(subsampler)
+            driver.run(offset=4, length=32)
+            driver.wait_done()
+            data = list(driver.upload())
+            times = list(driver.timestamps)
+            self.assertEqual(len(times), len(data))
+            self.assertEqual(np.diff(times).tolist(), [subsampler]*(len(times) - 1))
+            if compressed:
+                self.assertGreater(len(data), 32)
+                # Samples are one cycle apart, slow changes every 8 cycles
+                changes = [i for i in range(1, len(data)) if data[i] != data[i - 1]]
+                self.assertEqual(np.diff(changes).tolist(), [8]*(len(changes) - 1))
+            else:
+                self.assertEqual(len(set(d - t for d, t in zip(data, times))), 1)
+
+            with tempfile.TemporaryDirectory() as d:
+                filename = os.path.join(d, "dump.vcd")
+                driver.save(filename)
+                with open(filename) as f:
+                    stamps = [int(l[1:]) for l in f if l.startswith("#")]
+                self.assertEqual(stamps[-1], 2*times[-1] + 2)
+                filename = os.path.join(d, "dump.dsc")
+                driver.save(filename)
+                with BinaryDump() as dump:
+                    dump.read(filename)
+                    self.assertEqual(list(dump.timestamps), times)
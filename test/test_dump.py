@@ -3,8 +3,11 @@
 
 import unittest
 import os
+import zipfile
 from math import cos, sin
 
+import numpy as np
+
 from darkscope.software.dump import *
 
 #TODO:
@@ -19,11 +22,85 @@ dump.add(DumpVariable("cos", 8, [128+128*cos(j/(2*pi*16)) for j in range(1024)])
 
 
 class TestDump(unittest.TestCase):
+    def test_dump_view(self):
+        data = DumpData(16)
+        data.extend(range(100))
+        layout_dump = Dump()
+        layout_dump.add_from_layout([("low", 4), ("high", 12)], data)
+        low, high, clk = layout_dump.variables
+        self.assertIsInstance(low.values, DumpView)
+        self.assertEqual(len(low), 200)
+        self.assertEqual(list(low.get_window(5, 11)), [2, 3, 3, 4, 4, 5])
+        self.assertEqual(high.values[-1], 99 >> 4)
+        self.assertEqual(list(clk.values[:4]), [1, 0, 1, 0])
+        self.assertEqual(len(clk), 200)
+
+    def test_dump_flatten(self):
+        data = DumpData(8)
+        data.extend([0x5a, 0x0f])
+        flatten_dump = Dump()
+        flatten_dump.add_from_layout_flatten([("value", 8)], data)
+        value, clk = flatten_dump.variables
+        self.assertEqual(list(value.values), [0, 1, 0, 1, 1, 0, 1, 0, 1, 1, 1, 1, 0, 0, 0, 0])
+        self.assertEqual(list(clk.values), [1, 1, 1, 1, 0, 0, 0, 0]*2)
+
+        flatten_dump = Dump()
+        flatten_dump.add_from_layout_flatten([("a", 1), ("b", 1)], data)
+        a, b, clk = flatten_dump.variables
+        self.assertEqual(list(a.values), [0, 0, 1, 1])
+        self.assertEqual(list(b.values), [1, 1, 1, 1])
+        self.assertEqual(list(clk.values), [1, 0]*2)
+
+        flatten_dump = Dump()
+        flatten_dump.add_from_layout_flatten([("low", 2), ("high", 4)], data)
+        low, high, clk = flatten_dump.variables
+        # Narrower fields hold their last bit to stay aligned with the clock
+        self.assertEqual(list(low.values), [0, 1, 1, 1, 1, 1, 1, 1])
+        self.assertEqual(list(high.values), [0, 1, 1, 0, 1, 1, 0, 0])
+        self.assertEqual(list(clk.values), [1, 1, 0, 0]*2)
+
+    def test_binary(self):
+        filename = "dump.dsc"
+        data = DumpData(72)
+        data.extend([j | (j % 7) << 64 for j in range(1024)])
+        BinaryDump(data=data, layouts={0: [("low", 64), ("high", 8)]}, samplerate=1e6).write(filename)
+        with BinaryDump() as binary:
+            binary.read(filename)
+            self.assertEqual(list(binary.data), list(data))
+            self.assertEqual(binary.layouts, {0: [("low", 64), ("high", 8)]})
+            self.assertEqual(binary.samplerate, 1e6)
+            self.assertEqual([v.name for v in binary.variables], ["low", "high", "scope_clk"])
+            # Mapped data is copied on the first write
+            binary.data.clear()
+            binary.data.append(5)
+            self.assertEqual(list(binary.data), [5])
+        self.assertIsNone(binary.data)
+        BinaryDump(dump).write(filename)
+        with BinaryDump() as binary:
+            binary.read(filename)
+            for variable, expected in zip(binary.variables, dump.variables):
+                self.assertEqual(list(variable.values[:len(expected)]), expected.values)
+        os.remove(filename)
+
     def test_csv(self):
         filename = "dump.csv"
         CSVDump(dump).write(filename)
         os.remove(filename)
 
+    def test_csv_read(self):
+        filename = "dump.csv"
+        for radix in ["bin", "hex", "dec"]:
+            CSVDump(dump, radix=radix).write(filename)
+            csv = CSVDump()
+            csv.read(filename)
+            self.assertEqual(csv.radix, radix)
+            self.assertEqual([(v.name, v.width) for v in csv.variables],
+                             [(v.name, v.width) for v in dump.variables])
+            for variable, expected in zip(csv.variables, dump.variables):
+                self.assertEqual(len(variable), 1024)
+                self.assertEqual(list(variable.values[:len(expected)]), expected.values)
+        os.remove(filename)
+
     def test_py(self):
         filename = "dump.py"
         PythonDump(dump).write(filename)
@@ -36,7 +113,116 @@ class TestDump(unittest.TestCase):
         SigrokDump(dump).write(filename)
         os.remove(filename)
 
+    def test_sigrok_data(self):
+        sigrok = SigrokDump()
+        sigrok.add(DumpVariable("a", 1, [0, 1, 1, 0]))
+        sigrok.add(DumpVariable("b", 3, [5, 2, 7]))
+        self.assertIn("probe2=b[0]\nprobe3=b[1]\nprobe4=b[2]\n", sigrok.generate_metadata())
+        self.assertEqual(b"".join(sigrok.generate_data(window=3)), bytes([0b1010, 0b0101, 0b1111, 0b0000]))
+
+    def test_sigrok_read(self):
+        filename = "dump.sr"
+        SigrokDump(dump).write(filename)
+        sigrok = SigrokDump()
+        sigrok.read(filename)
+        self.assertEqual([(v.name, v.width) for v in sigrok.variables],
+                         [(v.name, v.width) for v in dump.variables])
+        for variable, expected in zip(sigrok.variables, dump.variables):
+            self.assertEqual(len(variable), 1024)
+            self.assertEqual(list(variable.values[:len(expected)]), expected.values)
+        os.remove(filename)
+
+    def test_sigrok_read_chunks(self):
+        filename = "dump.sr"
+        z = zipfile.ZipFile(filename, "w")
+        z.writestr("version", "2")
+        z.writestr("metadata", "[device 1]\ncapturefile=logic-1\ntotal probes=2\n"
+                               "samplerate=1.5 kHz\nprobe1=clk\nprobe2=data\nunitsize=1\n")
+        z.writestr("logic-1-1", bytes([1, 2, 3]))
+        z.writestr("logic-1-2", bytes([0, 3]))
+        z.close()
+        sigrok = SigrokDump()
+        sigrok.read(filename)
+        self.assertEqual(sigrok.samplerate, 1500)
+        self.assertIsInstance(sigrok.samplerate, int)
+        self.assertEqual(list(sigrok.variables[0].values), [1, 0, 1, 0, 1])
+        self.assertEqual(list(sigrok.variables[1].values), [0, 1, 1, 0, 1])
+        os.remove(filename)
+
     def test_vcd(self):
         filename = "dump.vcd"
         VCDDump(dump).write(filename)
         os.remove(filename)
+
+    def test_vcd_valuechange(self):
+        vcd = VCDDump()
+        vcd.add(DumpVariable("a", 4, [1, 1, 2, 2, 2, 3]))
+        vcd.add(DumpVariable("b", 1, [0, 1]))
+        vcd.finalize()
+        changes = "#0\nb0001 !\nb0 \"\n#1\nb1 \"\n#2\nb0010 !\n#5\nb0011 !\n#6\n"
+        self.assertEqual("".join(vcd.generate_valuechange(window=4)), changes)
+        self.assertEqual("".join(vcd.generate_valuechange()), changes)
+        last = [None]*2
+        chunks = list(vcd.generate_valuechange(final=False, end=3, last=last))
+        chunks += list(vcd.generate_valuechange(position=3, last=last))
+        self.assertEqual("".join(chunks), changes)
+
+    def test_vcd_read(self):
+        filename = "dump.vcd"
+        VCDDump(dump).write(filename)
+        vcd = VCDDump()
+        vcd.read(filename)
+        self.assertEqual([v.name for v in vcd.variables], [v.name for v in dump.variables])
+        for variable, expected in zip(vcd.variables, dump.variables):
+            self.assertEqual(len(variable), 1024)
+            self.assertEqual([int(v) for v in variable.values[:len(expected)]], expected.values)
+        vcd = VCDDump()
+        vcd.read(filename, signals=["sin"], start=100, stop=200)
+        self.assertEqual([v.name for v in vcd.variables], ["sin"])
+        self.assertEqual([int(v) for v in vcd.variables[0].values], dump.variables[4].values[100:200])
+        os.remove(filename)
+
+    def test_expand_changes(self):
+        words = np.array([3 | 5 << 4, 2 | 6 << 4, 0 | 7 << 4], dtype=np.uint64)
+        self.assertEqual(list(expand_changes(words, 4)), [5, 5, 5, 6, 7])
+        self.assertEqual(list(expand_changes(words, 4, previous=9)), [9, 9, 9, 5, 5, 5, 6, 7])
+        # Wider than 64 bits
+        self.assertEqual(list(expand_changes([1 << 70 | 1, 2 << 70 | 2], 4)), [1 << 66, 1 << 66, 1 << 66, 2 << 66])
+
+    def test_timestamps(self):
+        self.assertEqual(list(cycle_times([250, 253, 2], 8)), [250, 253, 258])
+        self.assertEqual(list(cycle_times([1, 2], 8, previous=300)), [513, 514])
+        self.assertEqual(list(cycle_times([9, 4, 3], 8, delta=True)), [0, 4, 7])
+        words = np.array([3 | 5 << 4, 2 | 6 << 4, 0 | 7 << 4], dtype=np.uint64)
+        self.assertEqual(list(expand_times([10, 16, 17], words, 4)), [10, 12, 14, 16, 17])
+        self.assertEqual(list(expand_times([10, 16, 17], words, 4, previous=2)), [4, 6, 8, 10, 12, 14, 16, 17])
+
+        data = DumpData(4)
+        data.extend([1, 1, 2])
+        timestamps = DumpData(64)
+        timestamps.extend([0, 4, 5])
+        vcd = VCDDump()
+        vcd.add_from_layout([("a", 4)], data, timestamps)
+        vcd.finalize()
+        self.assertEqual("".join(vcd.generate_valuechange()),
+            "#0\nb0001 !\nb1 \"\n#1\nb0 \"\n#8\nb1 \"\n#9\nb0 \"\n#10\nb0010 !\nb1 \"\n#11\nb0 \"\n#12\n")
+
+        filename = "dump.dsc"
+        BinaryDump(data=data, layouts={0: [("a", 4)]}, timestamps=timestamps).write(filename)
+        with BinaryDump() as binary:
+            binary.read(filename)
+            self.assertEqual(list(binary.data), [1, 1, 2])
+            self.assertEqual(list(binary.timestamps), [0, 4, 5])
+            self.assertEqual(list(binary.time(np.arange(6))), [0, 1, 8, 9, 10, 11])
+        os.remove(filename)
+
+    def test_dump_data(self):
+        for width in [8, 64, 100]:
+            data = DumpData(width)
+            values = [(j*0x9e3779b97f4a7c15) % 2**width for j in range(1024)]
+            for value in values:
+                data.append(value)
+            self.assertEqual(list(data), values)
+            for low, high in [(0, 1), (3, 7), (0, width), (width//2, width)]:
+                self.assertEqual([int(v) for v in data[low:high]],
+                                 [(v >> low) % 2**(high - low) for v in values])